@@ -0,0 +1,310 @@
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import argparse
+import tempfile
+import threading
+import itertools
+import subprocess
+import socketserver
+import http.client
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import sakuraCast as sc
+
+INPUTS = {
+    "480p30": {"size": "640x480", "rate": 30, "subtitles": False},
+    "720p60": {"size": "1280x720", "rate": 60, "subtitles": False},
+    "1080p24-subs": {"size": "1920x1080", "rate": 24, "subtitles": True},
+}
+
+class NullTranscodeCache(sc.TranscodeCache):
+    """Keeps benchmark runs from being served out of (or filling) the real transcode cache."""
+    def lookup(self, key):
+        return None
+
+    def open_part(self, key):
+        return None, None
+
+def write_srt(path, duration):
+    with open(path, "w") as f:
+        for n in range(int(duration // 2)):
+            f.write(f"{n + 1}\n{sc.format_time(n * 2)},000 --> {sc.format_time(n * 2 + 1)},500\nBenchmark line {n + 1}\n\n")
+
+def make_input(work_dir, name, spec, duration):
+    path = os.path.join(work_dir, f"{name}-{duration}s.mkv")
+    if os.path.exists(path):
+        return path
+    cmd = [
+        "ffmpeg", "-y", "-v", "error",
+        "-f", "lavfi", "-i", f"testsrc2=size={spec['size']}:rate={spec['rate']}:duration={duration}",
+        "-f", "lavfi", "-i", f"sine=frequency=440:duration={duration}",
+    ]
+    maps = ["-map", "0:v", "-map", "1:a"]
+    if spec["subtitles"]:
+        srt_path = os.path.join(work_dir, f"{name}.srt")
+        write_srt(srt_path, duration)
+        cmd += ["-i", srt_path]
+        maps += ["-map", "2:s"]
+    cmd += maps + ["-c:v", "libx264", "-preset", "veryfast", "-g", str(spec["rate"] * 2), "-c:a", "aac", "-c:s", "srt", path]
+    subprocess.run(cmd, check=True)
+    return path
+
+def child_cpu():
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+def fetch(port, token, limit=None):
+    """Pulls a stream the way a Cast receiver does and times the first media bytes."""
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+    started = time.perf_counter()
+    conn.request("GET", f"/stream.mp4?id={token}")
+    resp = conn.getresponse()
+    ttfb = None
+    received = 0
+    while limit is None or received < limit:
+        chunk = resp.read1(64*1024)
+        if not chunk: break
+        if ttfb is None: ttfb = time.perf_counter() - started
+        received += len(chunk)
+    elapsed = time.perf_counter() - started
+    conn.close()
+    return {"status": resp.status, "ttfb": ttfb, "bytes": received, "elapsed": elapsed}
+
+def finish_sessions():
+    for shared in list(sc.SHARED_TRANSCODES.values()):
+        sc.release_shared_transcode(shared)
+
+def run_case(port, path, duration, case):
+    settings = {
+        "video_file": path, "audio_file": None, "subtitle_file": "internal:0" if case["subtitles"] else None,
+        "headers_dict": {}, "audio_headers": {},
+        "encoder": case["encoder"], "hw_args": list(case["hw_args"]),
+        "aspect_ratio": "16/9", "resolution": case["resolution"], "fps": case["fps"],
+        "crop_top": case["crop"], "crop_bottom": case["crop"], "crop_left": 0, "crop_right": 0,
+        "passthrough": "transcode", "rung": 0,
+    }
+    cpu_before = child_cpu()
+
+    token = sc.register_stream(settings, 0)
+    result = fetch(port, token)
+    shared = sc.SHARED_TRANSCODES.get(token)
+    stats = shared.stats() if shared else {}
+    finish_sessions()
+
+    seek_token = sc.register_stream(settings, duration / 2)
+    seek = fetch(port, seek_token, limit=256*1024)
+    finish_sessions()
+
+    cpu = child_cpu()
+    encoded = stats.get("out_time") or 0
+    result.update(
+        throughput_mbps=round(result["bytes"] * 8 / result["elapsed"] / 1e6, 2) if result["elapsed"] else None,
+        speed=round(encoded / result["elapsed"], 2) if result["elapsed"] else None,
+        fps=stats.get("fps"),
+        dropped_frames=stats.get("dropped_frames"),
+        duplicated_frames=stats.get("duplicated_frames"),
+        seek_restart=seek["ttfb"],
+        cpu_per_minute=round((cpu - cpu_before) / (encoded / 60), 2) if cpu is not None and encoded else None,
+    )
+    return result
+
+def legacy_relay(pipe, sock):
+    """The relay loop sakuraCast used before relay_pipe(): 64 KiB reads through a buffered pipe into the socket."""
+    wfile = sock.makefile("wb", buffering=0)
+    while True:
+        data = pipe.read(64*1024)
+        if not data: break
+        wfile.write(data)
+
+RELAY_METHODS = {
+    "legacy": (legacy_relay, 10**6),
+    "buffered": (lambda pipe, sock: sc.relay_pipe(pipe, sock, zero_copy=False), 0),
+    "splice": (sc.relay_pipe, 0),
+}
+
+def drain(listener, result):
+    conn, _ = listener.accept()
+    buf = bytearray(1024**2)
+    received = 0
+    while True:
+        n = conn.recv_into(buf)
+        if not n: break
+        received += n
+    conn.close()
+    result["received"] = received
+
+def run_relay_case(method, size_mb, bitrate):
+    """Pushes size_mb MiB from a child's stdout to a loopback client and measures the relaying thread's CPU."""
+    relay, bufsize = RELAY_METHODS[method]
+    listener = socket.create_server(("127.0.0.1", 0))
+    result = {}
+    drainer = threading.Thread(target=drain, args=(listener, result))
+    drainer.start()
+    sock = socket.create_connection(listener.getsockname())
+    producer = f"import sys; b = bytes(1024**2); [sys.stdout.buffer.write(b) for _ in range({size_mb})]"
+    proc = subprocess.Popen([sys.executable, "-c", producer], stdout=subprocess.PIPE, bufsize=bufsize)
+
+    cpu_before, started = time.thread_time(), time.perf_counter()
+    relay(proc.stdout, sock)
+    elapsed, cpu = time.perf_counter() - started, time.thread_time() - cpu_before
+    sock.close()
+    proc.wait()
+    drainer.join()
+    listener.close()
+
+    size = size_mb * 1024**2
+    return {
+        "method": method,
+        "bytes": result.get("received"),
+        "throughput_mbps": round(size * 8 / elapsed / 1e6, 1),
+        "cpu_seconds_per_gb": round(cpu / (size / 1e9), 3),
+        "cpu_percent_at_bitrate": round(cpu / size * bitrate * 1000 / 8 * 100, 4),
+    }
+
+def relay_benchmark(args):
+    bitrate = max(rung["bitrate"] for rung in sc.RATE_LADDERS["1920x1080"])
+    methods = [m for m in RELAY_METHODS if m != "splice" or hasattr(os, "splice")]
+    results = []
+    for method in methods:
+        for _ in range(args.relay_runs):
+            measured = run_relay_case(method, args.relay_mb, bitrate)
+            results.append(measured)
+            print(f"relay {method}: {measured['throughput_mbps']} Mbit/s, {measured['cpu_seconds_per_gb']} CPU s/GB, {measured['cpu_percent_at_bitrate']}% CPU at {bitrate} kbit/s")
+    return {"bitrate_kbps": bitrate, "size_mb": args.relay_mb, "results": results}
+
+def legacy_video_filter(settings, offset):
+    """The software-encoder graph sakuraCast built before plan_video_filter(), for comparison."""
+    burn = [f for f in sc.subtitle_filters(settings, 0) if not f.startswith("setpts")]
+    sub_filter = f"setpts=PTS+{offset}/TB,{burn[0]},setpts=PTS-{offset}/TB," if burn else ""
+    res_w, res_h = sc.rate_rung(settings)["resolution"].split('x')
+    fps_val = sc.effective_fps(settings)
+    fps_filter_str = f",fps={fps_val}" if fps_val != "Original" else ""
+    ct, cb, cl, cr = settings["crop_top"], settings["crop_bottom"], settings["crop_left"], settings["crop_right"]
+    crop_filter = f"crop=iw-{cl}-{cr}:ih-{ct}-{cb}:{cl}:{ct},"
+    return f"{crop_filter}{sub_filter}scale={res_w}:{res_h},setsar=1,setdar={settings['aspect_ratio']}{fps_filter_str}"
+
+def run_filter_case(path, case):
+    """Encodes the clip with libx264 through the old and the planned filter graph and compares child CPU time."""
+    settings = {
+        "video_file": path, "subtitle_file": "internal:0" if case["subtitles"] else None, "encoder": "libx264",
+        "aspect_ratio": "16/9", "resolution": case["resolution"], "fps": case["fps"],
+        "crop_top": case["crop"], "crop_bottom": case["crop"], "crop_left": 0, "crop_right": 0, "rung": 0,
+    }
+    graphs = {"legacy": legacy_video_filter(settings, 0), "planned": sc.build_video_filter(dict(settings, source_info=sc.probe_media(path)), 0)}
+    result = {}
+    for name, graph in graphs.items():
+        cpu_before, started = child_cpu(), time.perf_counter()
+        subprocess.run(["ffmpeg", "-v", "error", "-i", path, "-vf", graph, "-an", "-c:v", "libx264", "-preset", "ultrafast", "-f", "null", "-"], check=True)
+        cpu = child_cpu()
+        result[name] = {"graph": graph, "seconds": round(time.perf_counter() - started, 3), "cpu_seconds": round(cpu - cpu_before, 3) if cpu is not None else None}
+    return result
+
+def benchmark_cases(args):
+    encoders = [(name, []) for name in args.encoders]
+    cached = sc.load_encoder_cache()
+    if cached and not args.encoders_only:
+        selected = cached["selected"]
+        if selected["encoder"] not in args.encoders:
+            encoders.append((selected["encoder"], selected["hw_args"]))
+    for (input_name, spec), (encoder, hw_args), resolution, fps, crop, subtitles in itertools.product(
+            [(n, INPUTS[n]) for n in args.inputs], encoders, args.resolutions, args.fps, args.crop, [False, True]):
+        if subtitles and not spec["subtitles"]:
+            continue
+        yield {"input": input_name, "encoder": encoder, "hw_args": hw_args, "resolution": resolution, "fps": fps, "crop": crop, "subtitles": subtitles}
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the sakuraCast streaming pipeline without Tk or a Chromecast.")
+    parser.add_argument("--output", default="benchmark.json", help="where to write the JSON results")
+    parser.add_argument("--duration", type=int, default=20, help="length of each synthetic clip in seconds")
+    parser.add_argument("--inputs", nargs="+", default=list(INPUTS), choices=list(INPUTS))
+    parser.add_argument("--encoders", nargs="+", default=["libx264"])
+    parser.add_argument("--encoders-only", action="store_true", help="skip the cached hardware encoder")
+    parser.add_argument("--resolutions", nargs="+", default=list(sc.RATE_LADDERS))
+    parser.add_argument("--fps", nargs="+", default=["Original", "30"])
+    parser.add_argument("--crop", nargs="+", type=int, default=[0, 60], help="pixels cropped from top and bottom")
+    parser.add_argument("--keep-inputs", action="store_true", help="keep the generated clips in cache/bench")
+    parser.add_argument("--relay", action="store_true", help="only compare the pipe-to-socket relay methods")
+    parser.add_argument("--filters", action="store_true", help="only compare libx264 CPU cost of the old and planned filter graphs")
+    parser.add_argument("--relay-mb", type=int, default=1024, help="data pushed through each relay run")
+    parser.add_argument("--relay-runs", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.relay:
+        report = {"version": sc.VERSION, "platform": sc.platform.platform(), "created": time.strftime("%Y-%m-%dT%H:%M:%S"), "relay": relay_benchmark(args)}
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote relay results to {args.output}")
+        return
+
+    if not shutil.which("ffmpeg"):
+        sys.exit("ffmpeg not found in PATH")
+
+    sc.TRANSCODE_CACHE = NullTranscodeCache(None, 0)
+    work_dir = os.path.join(sc.CACHE_DIR, "bench") if args.keep_inputs else tempfile.mkdtemp(prefix="sakuracast-bench-")
+    os.makedirs(work_dir, exist_ok=True)
+
+    if args.filters:
+        results = []
+        try:
+            for case in benchmark_cases(argparse.Namespace(**dict(vars(args), encoders=["libx264"], encoders_only=True))):
+                path = make_input(work_dir, case["input"], INPUTS[case["input"]], args.duration)
+                measured = run_filter_case(path, case)
+                results.append(dict(case, **measured))
+                print(f"{case['input']} -> {case['resolution']} fps={case['fps']} crop={case['crop']} subs={case['subtitles']}: "
+                      f"legacy {measured['legacy']['cpu_seconds']}s CPU, planned {measured['planned']['cpu_seconds']}s CPU")
+        finally:
+            if not args.keep_inputs:
+                shutil.rmtree(work_dir, ignore_errors=True)
+        report = {"version": sc.VERSION, "platform": sc.platform.platform(), "duration": args.duration, "created": time.strftime("%Y-%m-%dT%H:%M:%S"), "filters": results}
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote {len(results)} filter comparisons to {args.output}")
+        return
+
+    socketserver.ThreadingTCPServer.allow_reuse_address = True
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), sc.FFmpegStreamHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+
+    results = []
+    try:
+        for case in benchmark_cases(args):
+            path = make_input(work_dir, case["input"], INPUTS[case["input"]], args.duration)
+            label = " ".join(f"{k}={v}" for k, v in case.items() if k != "hw_args")
+            try:
+                measured = run_case(port, path, args.duration, case)
+            except Exception as e:
+                measured = {"error": str(e)}
+            results.append(dict(case, **measured))
+            print(f"{label}: ttfb={measured.get('ttfb')} speed={measured.get('speed')} seek={measured.get('seek_restart')} cpu/min={measured.get('cpu_per_minute')}")
+    finally:
+        server.shutdown()
+        finish_sessions()
+        if not args.keep_inputs:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        "version": sc.VERSION,
+        "ffmpeg": sc.encoder_probe_key()["version"],
+        "platform": sc.platform.platform(),
+        "duration": args.duration,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {len(results)} results to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,10 @@
 import os
-import tkinter as tk
-from tkinter import ttk, filedialog, messagebox
+try:
+    import tkinter as tk
+    from tkinter import ttk, filedialog, messagebox, font as tkfont
+except ImportError:
+    tk = None
 import threading
-import pychromecast
 import socket
 import socketserver
 import http.server
@@ -10,13 +12,32 @@ import subprocess
 import time
 from collections import deque
 import platform
-import yt_dlp
 import webbrowser
-import requests
 import glob
+import hashlib
+import json
+import shutil
+import urllib.parse
+import urllib.request
+import bisect
+import itertools
+import atexit
+import errno
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Empty
+from uuid import UUID
 
 VIDEO_MIME = "video/mp4"
 AUDIO_MIME = "audio/mpeg"
+AUDIO_COPY_FORMATS = {"mp3": ("mp3", AUDIO_MIME), "aac": ("mp4", "audio/mp4"), "flac": ("flac", "audio/flac"), "opus": ("ogg", "audio/ogg"), "vorbis": ("ogg", "audio/ogg")}
+AUDIO_DIRECT_CONTAINERS = {"mp3": AUDIO_MIME, "flac": "audio/flac", "ogg": "audio/ogg", "wav": "audio/wav", "mov,mp4,m4a,3gp,3g2,mj2": "audio/mp4"}
+AUDIO_TRANSCODE_FORMAT = ("mp4", "audio/mp4")
+HLS_MIME = "application/x-mpegURL"
 
 BG_COLOR = "#1e1e1e"
 FG_COLOR = "#e0e0e0"
@@ -26,6 +47,108 @@ SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 ICON = os.path.join(SCRIPT_DIR, "sakura.png")
 VERSION = "0.99"
 
+CACHE_DIR = os.path.join(SCRIPT_DIR, "cache")
+HLS_CACHE_DIR = os.path.join(CACHE_DIR, "hls")
+HLS_CACHE_LIMIT = 2 * 1024**3
+TRANSCODE_CACHE_DIR = os.path.join(CACHE_DIR, "transcodes")
+TRANSCODE_CACHE_LIMIT = 20 * 1024**3
+PROBE_CACHE_DIR = os.path.join(CACHE_DIR, "probe")
+PROBE_CACHE_LIMIT = 64 * 1024**2
+KEYFRAME_CACHE_DIR = os.path.join(CACHE_DIR, "keyframes")
+KEYFRAME_CACHE_LIMIT = 256 * 1024**2
+SUBTITLE_CACHE_DIR = os.path.join(CACHE_DIR, "subtitles")
+SUBTITLE_CACHE_LIMIT = 256 * 1024**2
+TEXT_SUBTITLE_CODECS = {"subrip", "srt", "ass", "ssa", "webvtt", "mov_text", "text"}
+THUMB_CACHE_DIR = os.path.join(CACHE_DIR, "thumbs")
+THUMB_CACHE_LIMIT = 128 * 1024**2
+THUMB_OFFSET = 5
+BATCH_EXTENSIONS = (".mp4", ".mkv", ".avi", ".mov", ".m4v", ".webm", ".ts")
+BATCH_HW_SESSIONS = {"h264_nvenc": 3, "h264_amf": 2, "h264_videotoolbox": 2}
+BATCH_REPORT_INTERVAL = 2
+SEEK_DEBOUNCE = 0.4
+MAX_ENCODERS = max(2, (os.cpu_count() or 2) // 2)
+ENCODER_ADMISSION_TIMEOUT = 10
+URL_CACHE_TTL = 1800
+URL_EXPIRY_MARGIN = 300
+URL_RESOLVER_WORKERS = 4
+ENCODER_CACHE_PATH = os.path.join(CACHE_DIR, "encoders.json")
+DEVICE_CACHE_PATH = os.path.join(CACHE_DIR, "devices.json")
+QUEUE_PATH = os.path.join(CACHE_DIR, "queue.json")
+QUEUE_SAVE_DELAY = 1
+QUEUE_WARM_AHEAD = 4
+PLAYLIST_EXTENSIONS = (".m3u", ".m3u8")
+PLAYLIST_BATCH = 500
+DEVICE_CONNECT_TIMEOUT = 10
+RATE_SAMPLE_INTERVAL = 1
+TELEMETRY_INTERVAL = 5
+SEEK_SETTLE_TIME = 10
+UI_FLUSH_INTERVAL = 100
+POSITION_TICK = 500
+VAAPI_DEVICE = "/dev/dri/renderD128"
+SERVER_PORT = 8000
+SEGMENT_DURATION = 6
+SEGMENT_LOOKAHEAD = 4
+H264_PROFILES = {"Constrained Baseline", "Baseline", "Main", "High"}
+PASSTHROUGH_AUDIO = {"aac", "mp3"}
+DEVICE_PROFILES = {
+    "Chromecast": {"video_codecs": {"h264"}, "max_level": 41, "max_width": 1920, "max_height": 1080, "max_fps": 30},
+    "Chromecast Ultra": {"video_codecs": {"h264", "hevc", "vp9"}, "max_level": 42, "max_width": 3840, "max_height": 2160, "max_fps": 60},
+    "Chromecast HD": {"video_codecs": {"h264", "hevc", "vp9"}, "max_level": 42, "max_width": 1920, "max_height": 1080, "max_fps": 60},
+    "Chromecast with Google TV": {"video_codecs": {"h264", "hevc", "vp9"}, "max_level": 42, "max_width": 3840, "max_height": 2160, "max_fps": 60},
+    "Google TV Streamer": {"video_codecs": {"h264", "hevc", "vp9", "av1"}, "max_level": 42, "max_width": 3840, "max_height": 2160, "max_fps": 60},
+    "Google Nest Hub": {"video_codecs": {"h264", "vp9"}, "max_level": 31, "max_width": 1280, "max_height": 720, "max_fps": 30},
+    "Google Nest Hub Max": {"video_codecs": {"h264", "vp9"}, "max_level": 41, "max_width": 1920, "max_height": 1080, "max_fps": 30},
+}
+DEFAULT_DEVICE_PROFILE = DEVICE_PROFILES["Chromecast"]
+RATE_LADDERS = {
+    "640x480": [
+        {"resolution": "640x480", "fps": None, "bitrate": 1500},
+        {"resolution": "640x480", "fps": 30, "bitrate": 1000},
+        {"resolution": "480x360", "fps": 30, "bitrate": 700},
+        {"resolution": "320x240", "fps": 30, "bitrate": 400},
+    ],
+    "1280x720": [
+        {"resolution": "1280x720", "fps": None, "bitrate": 3500},
+        {"resolution": "1280x720", "fps": 30, "bitrate": 2500},
+        {"resolution": "960x540", "fps": 30, "bitrate": 1500},
+        {"resolution": "640x360", "fps": 30, "bitrate": 800},
+    ],
+    "1920x1080": [
+        {"resolution": "1920x1080", "fps": None, "bitrate": 6000},
+        {"resolution": "1920x1080", "fps": 30, "bitrate": 4500},
+        {"resolution": "1280x720", "fps": 30, "bitrate": 2500},
+        {"resolution": "960x540", "fps": 30, "bitrate": 1500},
+        {"resolution": "640x360", "fps": 30, "bitrate": 800},
+    ],
+}
+RATE_DOWNSHIFT_SPEED = 0.95
+RATE_UPSHIFT_SPEED = 1.6
+RATE_DOWNSHIFT_HEADROOM = 10
+RATE_MIN_SHIFT_INTERVAL = 20
+RATE_UPSHIFT_STABLE_TIME = 60
+SHARED_BUFFER_LIMIT = 64 * 1024**2
+SHARED_IDLE_TIMEOUT = 3
+SHARED_STALL_TIMEOUT = 15
+SHARED_MAX_LAG = 16 * 1024**2
+SHARED_SEND_BATCH = 4 * 1024**2
+SHARED_PRESTART_BUFFER = 8 * 1024**2
+RELAY_CHUNK = 256 * 1024
+RELAY_PIPE_SIZE = 1024**2
+RELAY_SOCKET_BUFFER = 1024**2
+RELAY_IOV_MAX = 512
+PROGRESSIVE_OUTPUT_ARGS = ["-f", "mp4", "-movflags", "frag_keyframe+empty_moov+default_base_moof", "pipe:1"]
+
+class StartupProfile:
+    def __init__(self):
+        self.enabled = False
+        self.started = time.perf_counter()
+
+    def mark(self, phase):
+        if self.enabled:
+            print(f"[startup] {phase}: {(time.perf_counter() - self.started) * 1000:.1f} ms")
+
+STARTUP_PROFILE = StartupProfile()
+
 def get_local_ip():
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     try:
@@ -42,8 +165,1927 @@ def format_time(seconds):
     except:
         return "00:00:00"
 
+def file_identity(path):
+    try:
+        st = os.stat(path)
+        return [os.path.abspath(path), st.st_mtime, st.st_size]
+    except (OSError, TypeError):
+        return [path, 0, 0]
+
+def stream_key(settings):
+    fields = ["audio_file", "subtitle_file", "encoder", "resolution", "fps", "aspect_ratio", "crop_top", "crop_bottom", "crop_left", "crop_right", "passthrough", "rung"]
+    ident = [file_identity(settings["video_file"])] + [settings.get(f) for f in fields]
+    return hashlib.sha1(json.dumps(ident).encode()).hexdigest()[:16]
+
+def stop_process(proc, timeout=5):
+    if proc is None or proc.poll() is not None:
+        return
+    proc.terminate()
+    try:
+        proc.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        print(f"Process {proc.pid} ignored terminate, killing")
+        proc.kill()
+        proc.wait()
+
+def process_usage(pid):
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        cpu = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        rss = int(fields[21]) * os.sysconf("SC_PAGE_SIZE")
+        return cpu, rss
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None, None
+
+class ProcessSupervisor:
+    def __init__(self, max_encoders):
+        self.max_encoders = max_encoders
+        self.slots = threading.BoundedSemaphore(max_encoders)
+        self.lock = threading.Lock()
+        self.procs = {}
+
+    def popen(self, cmd, session, kind="encoder", deferred=False, **kwargs):
+        """Starts a child; encoders take an admission slot first unless deferred, in which case admit() takes it later."""
+        admitted = kind == "encoder" and not deferred
+        if admitted and not self.slots.acquire(timeout=ENCODER_ADMISSION_TIMEOUT):
+            raise RuntimeError(f"Too many encoders running ({self.max_encoders}), refusing {session}")
+        try:
+            proc = subprocess.Popen(cmd, **kwargs)
+        except Exception:
+            if admitted: self.slots.release()
+            raise
+        with self.lock:
+            self.procs[proc.pid] = {"proc": proc, "session": session, "kind": kind, "program": os.path.basename(cmd[0]), "started": time.time(), "admitted": admitted}
+        threading.Thread(target=self.reap, args=(proc,), daemon=True).start()
+        return proc
+
+    def admit(self, proc):
+        if not self.slots.acquire(timeout=ENCODER_ADMISSION_TIMEOUT):
+            return False
+        with self.lock:
+            record = self.procs.get(proc.pid)
+            if record is not None and record["proc"] is proc and not record["admitted"]:
+                record["admitted"] = True
+                return True
+        self.slots.release()
+        return record is not None
+
+    def reap(self, proc):
+        proc.wait()
+        with self.lock:
+            record = self.procs.pop(proc.pid, None)
+        if record and record["admitted"]:
+            self.slots.release()
+
+    def run(self, cmd, session, kind, timeout=None, text=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL):
+        proc = self.popen(cmd, session, kind, stdout=stdout, stderr=stderr, text=text)
+        try:
+            out, err = proc.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            stop_process(proc, timeout=2)
+            raise
+        return subprocess.CompletedProcess(cmd, proc.returncode, out, err)
+
+    def stop_session(self, session):
+        with self.lock:
+            procs = [r["proc"] for r in self.procs.values() if r["session"] == session]
+        for proc in procs:
+            stop_process(proc)
+
+    def stop_all(self):
+        with self.lock:
+            procs = [r["proc"] for r in self.procs.values()]
+        for proc in procs:
+            stop_process(proc, timeout=2)
+
+    def snapshot(self):
+        with self.lock:
+            records = list(self.procs.items())
+        result = []
+        for pid, r in records:
+            cpu, rss = process_usage(pid)
+            result.append({"pid": pid, "session": r["session"], "kind": r["kind"], "program": r["program"],
+                           "age": round(time.time() - r["started"], 1), "cpu_seconds": cpu, "rss_bytes": rss})
+        return result
+
+SUPERVISOR = ProcessSupervisor(MAX_ENCODERS)
+atexit.register(SUPERVISOR.stop_all)
+
+def dir_size(path):
+    total = 0
+    for root_dir, _, files in os.walk(path):
+        for f in files:
+            try:
+                total += os.path.getsize(os.path.join(root_dir, f))
+            except OSError:
+                pass
+    return total
+
+def evict_cache(cache_dir, limit, keep=()):
+    if not os.path.isdir(cache_dir):
+        return
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        try:
+            size = dir_size(path) if os.path.isdir(path) else os.path.getsize(path)
+            entries.append((os.path.getmtime(path), name, size))
+        except OSError:
+            pass
+    total = sum(e[2] for e in entries)
+    for _, name, size in sorted(entries):
+        if total <= limit:
+            break
+        if name in keep or name.endswith(".part"):
+            continue
+        path = os.path.join(cache_dir, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try: os.remove(path)
+            except OSError: pass
+        total -= size
+
+def parse_range(header, size):
+    if not header:
+        return None
+    try:
+        unit, spec = header.strip().split("=", 1)
+        if unit.strip() != "bytes" or "," in spec:
+            return None
+        start_s, end_s = spec.strip().split("-", 1)
+        if start_s:
+            start = int(start_s)
+            end = int(end_s) if end_s else size - 1
+        else:
+            start = max(0, size - int(end_s))
+            end = size - 1
+    except ValueError:
+        return None
+    end = min(end, size - 1)
+    if start > end or start >= size:
+        return False
+    return start, end
+
+def parse_ratio(value, default=0.0):
+    try:
+        num, _, den = str(value).partition("/")
+        if not den:
+            den = num.partition(":")[2] or "1"
+            num = num.partition(":")[0]
+        return float(num) / float(den) if float(den) else default
+    except (ValueError, ZeroDivisionError):
+        return default
+
+def probe_media(path, headers_dict=None):
+    cmd = ["ffprobe", "-v", "error", "-show_format", "-show_streams", "-of", "json"]
+    if headers_dict:
+        cmd += ["-headers", "".join([f"{k}: {v}\r\n" for k, v in headers_dict.items()])]
+    try:
+        result = SUPERVISOR.run(cmd + [path], "probe", "probe", timeout=15, text=True, stdout=subprocess.PIPE)
+        data = json.loads(result.stdout or "{}")
+    except Exception as e:
+        print(f"Error probing {path}: {e}")
+        return None
+
+    fmt = data.get("format", {})
+    info = {
+        "duration": float(fmt.get("duration", 0) or 0),
+        "format_name": fmt.get("format_name"),
+        "start_time": float(fmt.get("start_time", 0) or 0),
+        "bit_rate": int(fmt.get("bit_rate", 0) or 0),
+        "video": None,
+        "audio": None,
+        "subtitles": [],
+        "cover_art": False,
+        "tags": {k.lower(): v for k, v in fmt.get("tags", {}).items() if k.lower() in ("title", "artist", "album")}
+    }
+    for stream in data.get("streams", []):
+        kind = stream.get("codec_type")
+        tags = stream.get("tags", {})
+        if kind == "video" and stream.get("disposition", {}).get("attached_pic"):
+            info["cover_art"] = True
+        elif kind == "video" and info["video"] is None:
+            width, height = stream.get("width", 0), stream.get("height", 0)
+            sar = parse_ratio(stream.get("sample_aspect_ratio"), 1.0) or 1.0
+            rotation = next((sd["rotation"] for sd in stream.get("side_data_list", []) if "rotation" in sd), tags.get("rotate", 0))
+            info["video"] = {
+                "codec": stream.get("codec_name"),
+                "profile": stream.get("profile"),
+                "level": stream.get("level", 0),
+                "pix_fmt": stream.get("pix_fmt"),
+                "width": width,
+                "height": height,
+                "fps": parse_ratio(stream.get("avg_frame_rate")) or parse_ratio(stream.get("r_frame_rate")),
+                "dar": parse_ratio(stream.get("display_aspect_ratio")) or (width * sar / height if height else 0),
+                "start_time": float(stream.get("start_time", 0) or 0),
+                "has_b_frames": stream.get("has_b_frames", 0),
+                "rotation": int(float(rotation or 0)),
+            }
+        elif kind == "audio" and info["audio"] is None:
+            info["audio"] = {"codec": stream.get("codec_name"), "channels": stream.get("channels", 2)}
+        elif kind == "subtitle":
+            info["subtitles"].append({
+                "index": stream.get("index"),
+                "sub_index": len(info["subtitles"]),
+                "codec": stream.get("codec_name"),
+                "language": tags.get("language"),
+                "title": tags.get("title"),
+            })
+    return info
+
+def probe_keyframes(path):
+    cmd = ["ffprobe", "-v", "error", "-select_streams", "v:0", "-show_entries", "packet=pts_time,flags", "-of", "csv=p=0", path]
+    try:
+        result = SUPERVISOR.run(cmd, "keyframes", "probe", timeout=120, text=True, stdout=subprocess.PIPE)
+    except Exception as e:
+        print(f"Error indexing keyframes of {path}: {e}")
+        return None
+    if result.returncode != 0:
+        return None
+
+    keyframes = []
+    for line in result.stdout.splitlines():
+        pts, _, flags = line.partition(",")
+        if "K" in flags and pts not in ("", "N/A"):
+            keyframes.append(float(pts))
+    return {"keyframes": sorted(keyframes)}
+
+class ProbeCache:
+    def __init__(self, cache_dir, limit, probe=probe_media):
+        self.cache_dir = cache_dir
+        self.limit = limit
+        self.probe = probe
+        self.entries = {}
+        self.inflight = {}
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=2)
+
+    def entry_key(self, path):
+        return hashlib.sha1(json.dumps(file_identity(path)).encode()).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def load(self, key):
+        try:
+            with open(self.entry_path(key)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save(self, key, info):
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_path = self.entry_path(key) + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(info, f)
+            os.replace(tmp_path, self.entry_path(key))
+        except OSError as e:
+            print(f"Error saving probe cache: {e}")
+
+    def get(self, path):
+        key = self.entry_key(path)
+        with self.lock:
+            if key in self.entries:
+                return self.entries[key]
+            event = self.inflight.get(key)
+            owner = event is None
+            if owner:
+                event = self.inflight[key] = threading.Event()
+        if not owner:
+            event.wait(30)
+            return self.entries.get(key)
+
+        try:
+            info = self.load(key)
+            if info is None:
+                info = self.probe(path)
+                if info is not None:
+                    self.save(key, info)
+            if info is not None:
+                with self.lock:
+                    self.entries[key] = info
+        finally:
+            with self.lock:
+                self.inflight.pop(key, None)
+            event.set()
+        return info
+
+    def peek(self, path):
+        try:
+            return self.entries.get(self.entry_key(path))
+        except OSError:
+            return None
+
+    def warm(self, paths):
+        for path in paths:
+            self.pool.submit(self.get, path)
+        self.pool.submit(evict_cache, self.cache_dir, self.limit)
+
+PROBE_CACHE = ProbeCache(PROBE_CACHE_DIR, PROBE_CACHE_LIMIT)
+KEYFRAME_CACHE = ProbeCache(KEYFRAME_CACHE_DIR, KEYFRAME_CACHE_LIMIT, probe=probe_keyframes)
+
+def snap_to_keyframe(path, seek_time, source_info=None):
+    if seek_time <= 0 or not path or not os.path.isfile(path):
+        return seek_time
+    index = KEYFRAME_CACHE.peek(path)
+    if not index or not index["keyframes"]:
+        return seek_time
+    start = (source_info or {}).get("start_time", 0)
+    pos = bisect.bisect_right(index["keyframes"], seek_time + start + 0.001) - 1
+    return max(0.0, round(index["keyframes"][pos] - start, 3)) if pos >= 0 else 0.0
+
+def select_audio_output(settings, source_info):
+    info = source_info or {}
+    if info.get("video") is not None or not info.get("audio"):
+        return None
+    codec = info["audio"]["codec"] or ""
+    mime = AUDIO_DIRECT_CONTAINERS.get(info.get("format_name"))
+    if mime and (codec in AUDIO_COPY_FORMATS or codec == "pcm_s16le") and not settings.get("audio_file") and os.path.isfile(settings["video_file"]):
+        return {"mode": "direct", "format": None, "mime": mime}
+    if codec in AUDIO_COPY_FORMATS:
+        fmt, mime = AUDIO_COPY_FORMATS[codec]
+        return {"mode": "copy", "format": fmt, "mime": mime}
+    fmt, mime = AUDIO_TRANSCODE_FORMAT
+    return {"mode": "transcode", "format": fmt, "mime": mime}
+
+def select_passthrough(source_info, settings, model_name=None):
+    video = (source_info or {}).get("video")
+    if not video or settings.get("rung", 0):
+        return "transcode"
+    if settings["subtitle_file"] or any(settings[f"crop_{side}"] for side in ("top", "bottom", "left", "right")):
+        return "transcode"
+
+    profile = DEVICE_PROFILES.get(model_name, DEFAULT_DEVICE_PROFILE)
+    if video["codec"] not in profile["video_codecs"] or video["pix_fmt"] not in ("yuv420p", "yuvj420p"):
+        return "transcode"
+    if video["codec"] == "h264" and (video["profile"] not in H264_PROFILES or video["level"] > profile["max_level"]):
+        return "transcode"
+    if video["width"] > profile["max_width"] or video["height"] > profile["max_height"] or video["fps"] > profile["max_fps"] + 0.5:
+        return "transcode"
+
+    res_w, res_h = (int(v) for v in settings["resolution"].split("x"))
+    if video["width"] > res_w or video["height"] > res_h:
+        return "transcode"
+    if settings["fps"] != "Original" and abs(float(settings["fps"]) - video["fps"]) > 0.5:
+        return "transcode"
+    if abs(video["dar"] - parse_ratio(settings["aspect_ratio"])) > 0.02:
+        return "transcode"
+
+    audio = source_info.get("audio")
+    if audio is None or audio["codec"] in PASSTHROUGH_AUDIO:
+        return "copy"
+    return "copy_video"
+
+def rate_ladder(resolution):
+    return RATE_LADDERS.get(resolution) or [{"resolution": resolution, "fps": None, "bitrate": 2500}]
+
+def rate_rung(settings):
+    ladder = rate_ladder(settings["resolution"])
+    return ladder[min(settings.get("rung", 0), len(ladder) - 1)]
+
+def effective_fps(settings):
+    fps_val = settings["fps"]
+    cap = rate_rung(settings)["fps"]
+    if cap and fps_val != "Original" and int(fps_val) > cap:
+        return str(cap)
+    return fps_val
+
+def parse_speed(value):
+    try:
+        return float(str(value).strip().rstrip("x"))
+    except ValueError:
+        return None
+
+class ProgressReader:
+    def __init__(self, proc):
+        self.values = {}
+        self.speed = None
+        self.updated = 0
+        threading.Thread(target=self.run, args=(proc.stderr,), daemon=True).start()
+
+    def run(self, pipe):
+        with pipe:
+            for line in iter(pipe.readline, b''):
+                text = line.decode('utf-8', errors='replace').strip()
+                key, sep, value = text.partition("=")
+                if not sep or " " in key:
+                    if text: print(f"[FFmpeg Log]: {text}")
+                    continue
+                self.values[key] = value.strip()
+                if key == "progress":
+                    self.speed = parse_speed(self.values.get("speed"))
+                    self.updated = time.time()
+
+    def number(self, key):
+        try:
+            return float(self.values.get(key, 0))
+        except ValueError:
+            return 0.0
+
+    def snapshot(self):
+        return {
+            "frames": self.number("frame"),
+            "fps": self.number("fps"),
+            "speed": self.speed,
+            "dropped_frames": self.number("drop_frames"),
+            "duplicated_frames": self.number("dup_frames"),
+            "output_bytes": self.number("total_size"),
+            "out_time": self.number("out_time_us") / 1e6,
+        }
+
+class Telemetry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions_started = 0
+        self.bytes_relayed = 0
+        self.relay_bytes = {"splice": 0, "sendfile": 0, "buffered": 0}
+        self.relay_send_seconds = 0.0
+        self.first_byte_seconds = 0.0
+        self.first_byte_count = 0
+
+    def session_started(self):
+        with self.lock:
+            self.sessions_started += 1
+
+    def relayed(self, size, method="buffered", seconds=0):
+        with self.lock:
+            self.bytes_relayed += size
+            self.relay_bytes[method] += size
+            self.relay_send_seconds += seconds
+
+    def first_byte(self, seconds):
+        with self.lock:
+            self.first_byte_seconds += seconds
+            self.first_byte_count += 1
+
+TELEMETRY = Telemetry()
+
+def tune_pipe(pipe, size=RELAY_PIPE_SIZE):
+    """Grows a child's stdout pipe so ffmpeg blocks less often on a momentarily slow client (Linux only)."""
+    if fcntl is not None and hasattr(fcntl, "F_SETPIPE_SZ"):
+        try:
+            fcntl.fcntl(pipe.fileno(), fcntl.F_SETPIPE_SZ, size)
+        except OSError:
+            pass
+
+def tune_socket(sock, size=RELAY_SOCKET_BUFFER):
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, size)
+    except OSError:
+        pass
+
+def relay_pipe(pipe, sock, started=None, zero_copy=True):
+    """Copies a child's stdout to a client socket, kernel-side with splice() where possible; returns bytes sent."""
+    started = started or time.perf_counter()
+    src, sent = pipe.fileno(), 0
+    tune_pipe(pipe)
+    tune_socket(sock)
+    if zero_copy and hasattr(os, "splice"):
+        try:
+            while True:
+                n = os.splice(src, sock.fileno(), RELAY_CHUNK)
+                if not n:
+                    return sent
+                if not sent:
+                    TELEMETRY.first_byte(time.perf_counter() - started)
+                sent += n
+                TELEMETRY.relayed(n, "splice")
+        except OSError as e:
+            if sent or e.errno not in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                raise
+    while True:
+        data = os.read(src, RELAY_CHUNK)
+        if not data:
+            return sent
+        before = time.perf_counter()
+        sock.sendall(data)
+        if not sent:
+            TELEMETRY.first_byte(before - started)
+        sent += len(data)
+        TELEMETRY.relayed(len(data), "buffered", time.perf_counter() - before)
+
+def relay_file(f, sock, offset, count):
+    """Sends part of an open file with sendfile() (socket.sendfile falls back to read/send itself); returns bytes sent."""
+    tune_socket(sock)
+    before = time.perf_counter()
+    sent = sock.sendfile(f, offset, count)
+    TELEMETRY.relayed(sent, "sendfile" if hasattr(os, "sendfile") else "buffered", time.perf_counter() - before)
+    return sent
+
+def send_pieces(sock, pieces):
+    """Writes a batch of buffered pieces with one gathered send per RELAY_IOV_MAX pieces instead of one per piece."""
+    views = [memoryview(piece) for piece in pieces if piece]
+    total = sum(len(view) for view in views)
+    before = time.perf_counter()
+    if not hasattr(sock, "sendmsg"):
+        for view in views:
+            sock.sendall(view)
+        views = []
+    while views:
+        n = sock.sendmsg(views[:RELAY_IOV_MAX])
+        while n:
+            if n >= len(views[0]):
+                n -= len(views.pop(0))
+            else:
+                views[0] = views[0][n:]
+                n = 0
+    TELEMETRY.relayed(total, "buffered", time.perf_counter() - before)
+    return total
+
+def format_stats(stats):
+    parts = [f"{stats.get('fps', 0):.0f} fps"]
+    if stats.get("speed") is not None:
+        parts.append(f"{stats['speed']:.2f}x")
+    parts.append(f"drop {stats.get('dropped_frames', 0):.0f}/dup {stats.get('duplicated_frames', 0):.0f}")
+    parts.append(f"{stats.get('bytes_sent', 0) / 1024**2:.1f} MB sent")
+    return " | ".join(parts)
+
+class RateController:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.speeds = deque(maxlen=10)
+        self.buffering = deque(maxlen=5)
+        self.headroom = None
+        self.last_shift = time.time()
+        self.last_trouble = time.time()
+
+    def observe(self, stats, player_state):
+        stats = stats or {}
+        if stats.get("speed") is not None:
+            self.speeds.append(stats["speed"])
+        self.buffering.append(player_state == "BUFFERING")
+        # Seconds encoded ahead of the device. A paced encoder reports low speed while far ahead, so speed only counts near the playhead.
+        self.headroom = stats.get("headroom")
+
+        slow = len(self.speeds) >= 3 and max(list(self.speeds)[-3:]) < RATE_DOWNSHIFT_SPEED
+        if self.headroom is not None:
+            slow = slow and self.headroom < RATE_DOWNSHIFT_HEADROOM
+        if slow or sum(self.buffering) >= 2:
+            self.last_trouble = time.time()
+            return "down"
+        fast = len(self.speeds) == self.speeds.maxlen and min(self.speeds) > RATE_UPSHIFT_SPEED
+        if fast and time.time() - self.last_trouble > RATE_UPSHIFT_STABLE_TIME:
+            return "up"
+        return None
+
+    def decide(self, stats, player_state, rung, rung_count):
+        if player_state == "PAUSED":
+            return rung
+        signal = self.observe(stats, player_state)
+        if time.time() - self.last_shift < RATE_MIN_SHIFT_INTERVAL:
+            return rung
+        if signal == "down" and rung < rung_count - 1:
+            return rung + 1
+        if signal == "up" and rung > 0 and time.time() - self.last_shift > RATE_UPSHIFT_STABLE_TIME:
+            return rung - 1
+        return rung
+
+def subtitle_filters(settings, offset):
+    sub_file = settings["subtitle_file"]
+    if not sub_file:
+        return []
+    crt_style = ("force_style='Alignment=2,Outline=1,Shadow=1,BorderStyle=4,""BackColour=&H80000000,Spacing=0.2,MarginV=15,FontSize=20,Bold=1'")
+
+    if sub_file.startswith("internal:"):
+        stream_idx = sub_file.split(":")[1]
+        extracted = SUBTITLE_CACHE.extracted(settings["video_file"], stream_idx)
+        if extracted:
+            escaped_path = extracted.replace("\\", "/").replace(":", "\\:")
+            burn = f"subtitles='{escaped_path}':{crt_style}"
+        else:
+            escaped_vid = settings["video_file"].replace("\\", "/").replace(":", "\\:")
+            burn = f"subtitles='{escaped_vid}':si={stream_idx}:{crt_style}"
+    elif os.path.exists(sub_file):
+        escaped_path = sub_file.replace("\\", "/").replace(":", "\\:")
+        burn = f"subtitles='{escaped_path}':{crt_style}"
+    else:
+        return []
+    # Input seeking restarts timestamps at zero; shift them so libass picks the right cues.
+    if offset:
+        return [f"setpts=PTS+{offset}/TB", burn, f"setpts=PTS-{offset}/TB"]
+    return [burn]
+
+def encoder_family(encoder):
+    if "vaapi" in encoder:
+        return "vaapi"
+    if "videotoolbox" in encoder:
+        return "videotoolbox"
+    return "software"
+
+def plan_video_filter(settings, offset, source_info=None):
+    """Lists the filter stages for a transcode, leaving out stages the probed source makes no-ops.
+
+    Without a probe every stage is kept. Scaling comes before the pixel format conversion so swscale does both in
+    one pass, subtitles are burned into the (usually smaller) output frame, and a lower target frame rate is
+    applied first so later stages see fewer frames."""
+    video = (source_info or {}).get("video") or {}
+    family = encoder_family(settings["encoder"])
+    res_w, res_h = (int(v) for v in rate_rung(settings)["resolution"].split('x'))
+    ct, cb, cl, cr = settings["crop_top"], settings["crop_bottom"], settings["crop_left"], settings["crop_right"]
+
+    crop = [f"crop=iw-{cl}-{cr}:ih-{ct}-{cb}:{cl}:{ct}"] if any((ct, cb, cl, cr)) else []
+    width, height = video.get("width"), video.get("height")
+    same_size = False
+    if width and height and "rotation" in video:
+        if video["rotation"] % 180:
+            width, height = height, width
+        same_size = (width - cl - cr, height - ct - cb) == (res_w, res_h)
+
+    fps_val = effective_fps(settings)
+    source_fps = video.get("fps")
+    fps, fps_first = [], False
+    if fps_val != "Original" and not (source_fps and abs(source_fps - float(fps_val)) < 0.01):
+        fps = [f"fps={fps_val}"]
+        fps_first = bool(source_fps) and source_fps > float(fps_val)
+
+    pix_fmt = video.get("pix_fmt")
+    subs = subtitle_filters(settings, offset)
+    aspect = [f"setdar={settings['aspect_ratio']}"]
+
+    if family == "vaapi":
+        upload = [] if pix_fmt == "nv12" else ["format=nv12"]
+        scale = [] if same_size else [f"scale_vaapi=w={res_w}:h={res_h}"]
+        stages = crop + subs + upload + ["hwupload"] + scale + aspect
+    else:
+        if family == "videotoolbox":
+            convert = [] if pix_fmt in ("yuv420p", "yuvj420p") else ["format=yuv420p"]
+        else:
+            convert = [] if pix_fmt in (None, "yuv420p", "yuvj420p") else ["format=yuv420p"]
+        scale = [] if same_size else [f"scale={res_w}:{res_h}"]
+        stages = crop + scale + convert + subs + aspect
+    return fps + stages if fps_first else stages + fps
+
+def build_video_filter(settings, offset):
+    return ",".join(plan_video_filter(settings, offset, settings.get("source_info")))
+
+def build_input_args(path, headers_dict, seek_time):
+    args = ["-ss", str(seek_time)]
+    if headers_dict:
+        header_str = "".join([f"{k}: {v}\r\n" for k, v in headers_dict.items()])
+
+        args += [
+            "-headers", header_str,
+            "-reconnect", "1",
+            "-reconnect_streamed", "1",
+            "-reconnect_delay_max", "5"
+        ]
+    return args + ["-i", path]
+
+def build_ffmpeg_cmd(settings, seek_time, output_args):
+    fps_val = effective_fps(settings)
+    fps_output_args = ["-r", fps_val] if fps_val != "Original" else []
+    bitrate = rate_rung(settings)["bitrate"]
+    rate_args = ["-b:v", f"{bitrate}k", "-maxrate", f"{bitrate}k", "-bufsize", f"{bitrate * 2}k"]
+
+    input_args = build_input_args(settings["video_file"], settings["headers_dict"], seek_time)
+    map_args = []
+    if settings.get("audio_file"):
+        input_args += build_input_args(settings["audio_file"], settings.get("audio_headers") or {}, seek_time)
+        map_args = ["-map", "0:v:0", "-map", "1:a:0"]
+
+    passthrough = settings.get("passthrough", "transcode")
+    if passthrough != "transcode":
+        audio_args = ["-c:a", "copy"] if passthrough == "copy" else ["-af", "aresample=async=1", "-c:a", "aac", "-b:a", "128k"]
+        return [
+            "ffmpeg", "-hide_banner", "-loglevel", "error", "-nostats", "-progress", "pipe:2",
+            "-protocol_whitelist", "file,http,https,tcp,tls,crypto,data",
+        ] + input_args + (map_args or ["-map", "0:v:0", "-map", "0:a:0?"]) + [
+            "-c:v", "copy",
+        ] + audio_args + output_args
+
+    return [
+        "ffmpeg", "-hide_banner", "-loglevel", "error", "-nostats", "-progress", "pipe:2",
+        "-protocol_whitelist", "file,http,https,tcp,tls,crypto,data",
+    ] + settings["hw_args"] + input_args + map_args + [
+        "-vf", build_video_filter(settings, seek_time),
+        "-af", "aresample=async=1",
+        "-c:v", settings["encoder"],
+    ] + fps_output_args + rate_args + [
+    ] + (["-preset", "veryfast"] if settings.get("offline") and "libx264" in settings["encoder"] else [
+        "-preset", "ultrafast" if "libx264" in settings["encoder"] else "fast",
+        "-tune", "zerolatency",
+    ]) + [
+        "-c:a", "aac", "-b:a", "128k",
+    ] + output_args
+
+def build_audio_cmd(settings, seek_time):
+    output = settings["audio_only"]
+    codec_args = ["-c:a", "copy"] if output["mode"] == "copy" else ["-af", "aresample=async=1", "-c:a", "aac", "-b:a", "192k"]
+    format_args = ["-f", output["format"]]
+    if output["format"] == "mp4":
+        format_args += ["-movflags", "empty_moov+default_base_moof", "-frag_duration", "1000000"]
+    return [
+        "ffmpeg", "-hide_banner", "-loglevel", "error", "-nostats", "-progress", "pipe:2",
+        "-protocol_whitelist", "file,http,https,tcp,tls,crypto,data",
+    ] + build_input_args(settings["video_file"], settings["headers_dict"], seek_time) + [
+        "-map", "0:a:0", "-vn", "-sn",
+    ] + codec_args + format_args + ["pipe:1"]
+
+def encoder_candidates(system):
+    if system == "Windows":
+        return [("h264_nvenc", [], []), ("h264_qsv", [], []), ("h264_amf", [], [])]
+    elif system == "Darwin":
+        return [("h264_videotoolbox", [], [])]
+    elif system in ["Linux", "FreeBSD"]:
+        candidates = []
+        if os.path.exists(VAAPI_DEVICE):
+            va_args = ["-vaapi_device", VAAPI_DEVICE]
+            candidates.append(("h264_vaapi", va_args, va_args + ["-vf", "format=nv12,hwupload"]))
+        candidates.append(("h264_nvenc", [], []))
+        return candidates
+    return []
+
+def test_ffmpeg_encoder(encoder_name, extra_args=[], source="color=c=black:s=640x480", frames=1):
+    test_cmd = [
+        "ffmpeg", "-y", 
+        "-f", "lavfi", "-i", source, 
+        "-frames:v", str(frames)
+    ] + extra_args + ["-c:v", encoder_name, "-f", "null", "-"]
+    
+    try:
+        started = time.perf_counter()
+        res = SUPERVISOR.run(test_cmd, "encoder-test", "probe", timeout=30)
+        return res.returncode == 0, time.perf_counter() - started
+    except: 
+        return False, 0
+
+def measure_encoder(encoder_name, hw_args, test_args):
+    result = {"encoder": encoder_name, "hw_args": hw_args, "ok": False, "frame_time": None, "clip_fps": None}
+    ok, frame_time = test_ffmpeg_encoder(encoder_name, test_args)
+    if not ok:
+        return result
+    clip_frames = 60
+    ok, clip_time = test_ffmpeg_encoder(encoder_name, test_args, "testsrc=s=640x480:r=30", clip_frames)
+    result.update(ok=ok, frame_time=round(frame_time, 3), clip_fps=round(clip_frames / clip_time, 1) if ok and clip_time else None)
+    return result
+
+def encoder_probe_key():
+    ffmpeg_path = shutil.which("ffmpeg")
+    try:
+        version = SUPERVISOR.run(["ffmpeg", "-version"], "encoder-test", "probe", timeout=10, text=True, stdout=subprocess.PIPE).stdout.split("\n")[0]
+    except Exception:
+        version = None
+    try:
+        node = [VAAPI_DEVICE, os.stat(VAAPI_DEVICE).st_rdev]
+    except OSError:
+        node = None
+    return {"ffmpeg": ffmpeg_path, "version": version, "render_node": node}
+
+def probe_encoders(system, key):
+    candidates = encoder_candidates(system) + [("libx264", [], [])]
+    with ThreadPoolExecutor(max_workers=len(candidates)) as pool:
+        results = list(pool.map(lambda c: measure_encoder(*c), candidates))
+    selected = next((r for r in results if r["ok"]), {"encoder": "libx264", "hw_args": []})
+    return {"key": key, "system": system, "results": results, "selected": {"encoder": selected["encoder"], "hw_args": selected["hw_args"]}}
+
+def load_encoder_cache():
+    try:
+        with open(ENCODER_CACHE_PATH) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def save_encoder_cache(data):
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(ENCODER_CACHE_PATH, "w") as f:
+            json.dump(data, f, indent=2)
+    except OSError as e:
+        print(f"Error saving encoder cache: {e}")
+
+def load_device_cache():
+    try:
+        with open(DEVICE_CACHE_PATH) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+def save_device_cache(entries):
+    devices = {d["uuid"]: d for d in load_device_cache()}
+    devices.update((d["uuid"], d) for d in entries)
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(DEVICE_CACHE_PATH, "w") as f:
+            json.dump(list(devices.values()), f, indent=2)
+    except OSError as e:
+        print(f"Error saving device cache: {e}")
+
+def forget_cached_device(uuid):
+    devices = [d for d in load_device_cache() if d["uuid"] != str(uuid)]
+    try:
+        with open(DEVICE_CACHE_PATH, "w") as f:
+            json.dump(devices, f, indent=2)
+    except OSError as e:
+        print(f"Error saving device cache: {e}")
+
+YDL_OPTS = {
+    'format': 'bestvideo+bestaudio/best/b',
+    'ignoreerrors': True,
+    'nocheckcertificate': True,
+    'quiet': False,
+    'no_warnings': False,
+    'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'extractor_args': {
+        'youtube': {'player_client': ['android', 'web']},
+        'nicovideo': {'player_client': ['watch_os', 'pc']}
+    }
+}
+
+def url_expiry(url, default_ttl=URL_CACHE_TTL):
+    query = urllib.parse.parse_qs(urllib.parse.urlsplit(url).query)
+    for name in ("expire", "expires", "Expires"):
+        try:
+            return min(int(query[name][0]), time.time() + default_ttl)
+        except (KeyError, ValueError):
+            pass
+    return time.time() + default_ttl
+
+def codec_family(codec):
+    codec = (codec or "").lower()
+    for prefix, family in (("avc", "h264"), ("h264", "h264"), ("hev", "hevc"), ("hvc", "hevc"), ("vp09", "vp9"), ("vp9", "vp9"), ("av01", "av1"), ("mp4a", "aac"), ("aac", "aac"), ("mp3", "mp3"), ("opus", "opus")):
+        if codec.startswith(prefix):
+            return family
+    return codec or None
+
+def has_video(fmt):
+    return fmt.get('vcodec') != 'none' and (fmt.get('height') or fmt.get('vcodec'))
+
+def has_audio(fmt):
+    return fmt.get('acodec') not in ('none',)
+
+def select_formats(formats, target):
+    target_height, target_fps, model_name = target
+    video_codecs = DEVICE_PROFILES.get(model_name, DEFAULT_DEVICE_PROFILE)["video_codecs"]
+    formats = [f for f in formats if f.get('url')]
+    videos = [f for f in formats if has_video(f)]
+    audios = [f for f in formats if f.get('vcodec') == 'none' and has_audio(f)]
+
+    if not videos:
+        audio = max(audios or formats, key=lambda f: (codec_family(f.get('acodec')) == "aac", f.get('abr') or f.get('tbr') or 0))
+        return audio, None
+
+    def rank(f):
+        return (
+            codec_family(f.get('vcodec')) not in video_codecs,
+            not has_audio(f) or f.get('acodec') is None,
+            f.get('fps') or 0,
+            f.get('tbr') or 0
+        )
+
+    above = [f for f in videos if (f.get('height') or 0) >= target_height and (not target_fps or (f.get('fps') or target_fps) >= target_fps - 0.5)]
+    if above:
+        video = min(above, key=lambda f: ((f.get('height') or 0),) + rank(f))
+    else:
+        tallest = max(f.get('height') or 0 for f in videos)
+        video = min([f for f in videos if (f.get('height') or 0) == tallest], key=rank)
+
+    if has_audio(video) or not audios:
+        return video, None
+    audio = max(audios, key=lambda f: (codec_family(f.get('acodec')) == "aac", f.get('abr') or f.get('tbr') or 0))
+    return video, audio
+
+H264_PROFILE_IDS = {0x42: "Baseline", 0x4D: "Main", 0x58: "Extended", 0x64: "High", 0x6E: "High 10", 0x7A: "High 4:2:2", 0xF4: "High 4:4:4 Predictive"}
+
+def probe_from_formats(video_fmt, audio_fmt, duration):
+    audio_src = audio_fmt or video_fmt
+    audio = {"codec": codec_family(audio_src.get('acodec')), "channels": audio_src.get('audio_channels') or 2} if has_audio(audio_src) and audio_src.get('acodec') else None
+    if not has_video(video_fmt) or not video_fmt.get('vcodec'):
+        return {"duration": duration, "video": None, "audio": audio, "subtitles": []}
+
+    vcodec = video_fmt['vcodec']
+    codec = codec_family(vcodec)
+    profile, level, pix_fmt = None, 0, "yuv420p"
+    if codec == "h264":
+        try:
+            params = vcodec.split(".")[1]
+            profile = H264_PROFILE_IDS.get(int(params[0:2], 16))
+            if profile == "Baseline" and int(params[2:4], 16) & 0x40:
+                profile = "Constrained Baseline"
+            level = int(params[4:6], 16)
+        except (IndexError, ValueError):
+            pass
+        if profile not in H264_PROFILES:
+            pix_fmt = None
+    width, height = video_fmt.get('width') or 0, video_fmt.get('height') or 0
+    return {
+        "duration": duration,
+        "video": {
+            "codec": codec,
+            "profile": profile,
+            "level": level,
+            "pix_fmt": pix_fmt,
+            "width": width,
+            "height": height,
+            "fps": video_fmt.get('fps') or 0,
+            "dar": width / height if height else 0
+        },
+        "audio": audio,
+        "subtitles": []
+    }
+
+def entry_thumbnail(info):
+    if info.get('thumbnail'):
+        return info['thumbnail']
+    thumbnails = [t for t in info.get('thumbnails') or [] if t.get('url')]
+    return thumbnails[-1]['url'] if thumbnails else None
+
+class UrlResolver:
+    def __init__(self, workers=URL_RESOLVER_WORKERS, limit=256):
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.cache = OrderedDict()
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def ydl(self, flat=False):
+        import yt_dlp
+        name = "flat" if flat else "full"
+        ydl = getattr(self.local, name, None)
+        if ydl is None:
+            opts = dict(YDL_OPTS)
+            if flat:
+                opts['extract_flat'] = 'in_playlist'
+            ydl = yt_dlp.YoutubeDL(opts)
+            setattr(self.local, name, ydl)
+        return ydl
+
+    def expand(self, url):
+        info = self.ydl(flat=True).extract_info(url, download=False)
+        if not info:
+            return []
+        if info.get('_type') == 'playlist' or 'entries' in info:
+            entries = []
+            for entry in info.get('entries') or []:
+                entry_url = entry and (entry.get('url') or entry.get('webpage_url'))
+                if entry_url:
+                    entries.append(QueueEntry(url=entry_url, title=entry.get('title') or 'Web Video', duration=entry.get('duration') or 0, thumbnail=entry_thumbnail(entry)))
+            return entries
+        self.store((url, "info"), info, expires=url_expiry(info.get('url') or ''))
+        return [QueueEntry(url=url, title=info.get('title', 'Web Video'), duration=info.get('duration', 0) or 0, thumbnail=entry_thumbnail(info))]
+
+    def from_info(self, info, target=None):
+        duration = info.get('duration', 0) or 0
+        video_fmt, audio_fmt = select_formats(info.get('formats') or [info], target or (0, 0, None))
+        resolved = {
+            'path': video_fmt['url'],
+            'headers': dict(video_fmt.get('http_headers') or {}),
+            'audio_path': None,
+            'audio_headers': {},
+            'title': info.get('title', 'Web Video'),
+            'duration': duration,
+            'probe': probe_from_formats(video_fmt, audio_fmt, duration)
+        }
+        if resolved['probe']['video'] is None and resolved['probe']['audio'] is None:
+            # Direct links often carry no codec info; ask ffprobe rather than guess.
+            resolved['probe'] = probe_media(resolved['path'], resolved['headers']) or resolved['probe']
+        if audio_fmt is not None and audio_fmt is not video_fmt:
+            resolved['audio_path'] = audio_fmt['url']
+            resolved['audio_headers'] = dict(audio_fmt.get('http_headers') or {})
+        return resolved
+
+    def info_expiry(self, info, target=None):
+        """Expiry of the formats from_info would pick, read from their URLs without probing anything."""
+        video_fmt, audio_fmt = select_formats(info.get('formats') or [info], target or (0, 0, None))
+        return min(url_expiry(video_fmt['url']), url_expiry((audio_fmt or {}).get('url') or ''))
+
+    def store(self, key, resolved, expires=None):
+        if expires is None:
+            expires = min(url_expiry(resolved['path']), url_expiry(resolved['audio_path'] or ''))
+        with self.lock:
+            self.cache[key] = (expires - URL_EXPIRY_MARGIN, resolved)
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.limit:
+                self.cache.popitem(last=False)
+
+    def lookup(self, key):
+        with self.lock:
+            cached = self.cache.get(key)
+            if cached and cached[0] > time.time():
+                return cached[1]
+            self.cache.pop(key, None)
+        return None
+
+    def resolve(self, entry, target=None):
+        cache_key = (entry.url, target)
+        resolved = self.lookup(cache_key)
+        if resolved is None:
+            info = self.lookup((entry.url, "info"))
+            if info is None:
+                info = self.ydl().extract_info(entry.url, download=False)
+                if not info:
+                    raise RuntimeError(f"Could not resolve {entry.url}")
+                self.store((entry.url, "info"), info, expires=self.info_expiry(info, target))
+            resolved = self.from_info(info, target)
+            self.store(cache_key, resolved)
+        return resolved
+
+    def resolve_async(self, entry, target=None):
+        return self.pool.submit(self.resolve, entry, target)
+
+URL_RESOLVER = UrlResolver()
+
+class HlsSession:
+    def __init__(self, settings, duration):
+        self.settings = settings
+        self.duration = duration
+        self.key = stream_key(settings)
+        self.dir = os.path.join(HLS_CACHE_DIR, self.key)
+        self.proc = None
+        self.progress = None
+        self.bytes_sent = 0
+        self.start_segment = 0
+        self.end_segment = None
+        self.existing = {}
+        self.lock = threading.Lock()
+        os.makedirs(self.dir, exist_ok=True)
+        os.utime(self.dir)
+
+    def segment_count(self):
+        return max(1, int(-(-self.duration // SEGMENT_DURATION)))
+
+    def segment_path(self, n):
+        return os.path.join(self.dir, f"seg_{n:05d}.m4s")
+
+    def init_path(self):
+        return os.path.join(self.dir, "init.mp4")
+
+    def playlist(self):
+        count = self.segment_count()
+        lines = [
+            "#EXTM3U",
+            "#EXT-X-VERSION:7",
+            f"#EXT-X-TARGETDURATION:{SEGMENT_DURATION}",
+            "#EXT-X-PLAYLIST-TYPE:VOD",
+            "#EXT-X-MEDIA-SEQUENCE:0",
+            "#EXT-X-INDEPENDENT-SEGMENTS",
+            '#EXT-X-MAP:URI="init.mp4"',
+        ]
+        for n in range(count):
+            seg_len = min(SEGMENT_DURATION, self.duration - n * SEGMENT_DURATION)
+            lines.append(f"#EXTINF:{max(seg_len, 0.001):.3f},")
+            lines.append(f"seg_{n:05d}.m4s")
+        lines.append("#EXT-X-ENDLIST")
+        return "\n".join(lines) + "\n"
+
+    def produced_until(self):
+        n = self.start_segment
+        while os.path.exists(self.segment_path(n)):
+            n += 1
+        return n
+
+    def stop_producer(self):
+        """Stops the producer and drops the segment it was writing, which the muxer closes short on SIGTERM."""
+        if self.proc is None:
+            return
+        interrupted = self.proc.poll() is None
+        stop_process(self.proc)
+        self.proc = None
+        if not interrupted:
+            return
+        n, last = self.start_segment, None
+        while self.rewritten(n):
+            last, n = n, n + 1
+        if last is not None:
+            try:
+                os.remove(self.segment_path(last))
+            except OSError:
+                pass
+
+    def segment_stamp(self, n):
+        try:
+            st = os.stat(self.segment_path(n))
+            return (st.st_mtime_ns, st.st_size)
+        except OSError:
+            return None
+
+    def rewritten(self, n):
+        stamp = self.segment_stamp(n)
+        return stamp is not None and stamp != self.existing.get(n)
+
+    def start_producer(self, n, segments=None):
+        self.stop_producer()
+        self.start_segment = n
+        self.end_segment = n + segments if segments else None
+        start_time = n * SEGMENT_DURATION
+        output_args = ["-t", str(segments * SEGMENT_DURATION)] if segments else []
+        output_args += [
+            "-force_key_frames", f"expr:gte(t,n_forced*{SEGMENT_DURATION})",
+            "-output_ts_offset", str(start_time),
+            "-f", "hls",
+            "-hls_time", str(SEGMENT_DURATION),
+            "-hls_segment_type", "fmp4",
+            "-hls_fmp4_init_filename", "init.mp4",
+            "-hls_segment_filename", os.path.join(self.dir, "seg_%05d.m4s"),
+            "-start_number", str(n),
+            "-hls_flags", "temp_file+independent_segments",
+            "-hls_playlist_type", "event",
+            os.path.join(self.dir, "ffmpeg.m3u8")
+        ]
+        cmd = build_ffmpeg_cmd(self.settings, start_time, output_args)
+        self.existing = {m: self.segment_stamp(m) for m in range(n, self.segment_count())}
+        self.proc = SUPERVISOR.popen(cmd, f"hls:{self.key}", stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        self.progress = ProgressReader(self.proc)
+        TELEMETRY.session_started()
+        print(f"HLS producer started at segment {n} ({self.key})")
+        evict_cache(HLS_CACHE_DIR, HLS_CACHE_LIMIT, keep=(self.key,))
+
+    def ensure_segment(self, n):
+        with self.lock:
+            if os.path.exists(self.segment_path(n)):
+                return
+            running = self.proc is not None and self.proc.poll() is None
+            within = self.end_segment is None or n < self.end_segment
+            if running and within and self.start_segment <= n <= self.produced_until() + SEGMENT_LOOKAHEAD:
+                return
+            self.start_producer(n)
+
+    def prewarm(self):
+        """Encodes only the first SEGMENT_LOOKAHEAD segments so a queued item doesn't compete with the live encode."""
+        with self.lock:
+            if self.proc is None and not os.path.exists(self.segment_path(0)):
+                self.start_producer(0, segments=SEGMENT_LOOKAHEAD)
+
+    def get_segment(self, n, timeout=30):
+        if n < 0 or n >= self.segment_count():
+            return None
+        self.ensure_segment(n)
+        deadline = time.time() + timeout
+        path = self.segment_path(n)
+        while time.time() < deadline:
+            if os.path.exists(path):
+                return path
+            if self.proc is not None and self.proc.poll() is not None:
+                return path if os.path.exists(path) else None
+            time.sleep(0.1)
+        return None
+
+    def get_init(self, timeout=30):
+        if not os.path.exists(self.init_path()):
+            self.ensure_segment(0 if self.proc is None else self.start_segment)
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if os.path.exists(self.init_path()):
+                return self.init_path()
+            time.sleep(0.1)
+        return None
+
+    def stats(self):
+        running = self.proc is not None and self.proc.poll() is None
+        stats = self.progress.snapshot() if self.progress else {}
+        stats.update(speed=stats.get("speed") if running else None, lag_ratio=0, skips=0, clients=0, bytes_sent=self.bytes_sent, running=running)
+        return stats
+
+    def sent(self, size):
+        self.bytes_sent += size
+
+    def stop(self):
+        with self.lock:
+            self.stop_producer()
+
+class TranscodeCache:
+    def __init__(self, cache_dir, limit):
+        self.cache_dir = cache_dir
+        self.limit = limit
+        self.pinned = set()
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.mp4")
+
+    def lookup(self, key):
+        path = self.entry_path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return path
+
+    def open_part(self, key):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        part_path = os.path.join(self.cache_dir, f"{key}.{threading.get_ident()}.part")
+        return open(part_path, "wb"), part_path
+
+    def commit(self, key, part_path):
+        tmp_path = self.entry_path(key) + ".tmp"
+        cmd = ["ffmpeg", "-y", "-i", part_path, "-c", "copy", "-movflags", "+faststart", "-f", "mp4", tmp_path]
+        try:
+            res = SUPERVISOR.run(cmd, f"cache:{key}", "remux")
+            if res.returncode == 0:
+                self.store(key, tmp_path)
+        except Exception as e:
+            print(f"Error caching transcode: {e}")
+        finally:
+            for path in (part_path, tmp_path):
+                if os.path.exists(path): os.remove(path)
+
+    def store(self, key, path):
+        os.replace(path, self.entry_path(key))
+        print(f"Transcode cached: {key}")
+        evict_cache(self.cache_dir, self.limit, keep={f"{k}.mp4" for k in self.pinned | {key}})
+
+    def discard(self, part_path):
+        try: os.remove(part_path)
+        except OSError: pass
+
+TRANSCODE_CACHE = TranscodeCache(TRANSCODE_CACHE_DIR, TRANSCODE_CACHE_LIMIT)
+
+def batch_workers(encoder):
+    """Parallel batch encodes: one per spare admission slot (one is left for live playback), capped by the
+    encoder's session limit. libx264 already threads across cores, so it gets one worker per four cores."""
+    cores = os.cpu_count() or 2
+    limit = BATCH_HW_SESSIONS.get(encoder, max(1, cores // 4) if encoder == "libx264" else SUPERVISOR.max_encoders)
+    return max(1, min(limit, SUPERVISOR.max_encoders - 1))
+
+def batch_entries(sources):
+    for source in sources:
+        if os.path.isdir(source):
+            for root_dir, dirs, files in os.walk(source):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.lower().endswith(BATCH_EXTENSIONS):
+                        yield QueueEntry(path=os.path.join(root_dir, name))
+        elif source.lower().endswith(PLAYLIST_EXTENSIONS):
+            for entries in parse_m3u(source):
+                yield from entries
+        else:
+            yield QueueEntry(path=source)
+
+class BatchPreparer:
+    """Encodes jobs to cast-ready MP4s in the transcode cache ahead of playback; items already there are skipped,
+    so an interrupted batch resumes by running it again."""
+    def __init__(self, jobs, workers, report=print):
+        self.jobs = jobs
+        self.workers = workers
+        self.report = report
+        self.lock = threading.Lock()
+        self.active = {}
+        self.done = self.skipped = self.failed = 0
+        self.running = False
+        self.cancelled = False
+
+    def run(self):
+        self.running = True
+        TRANSCODE_CACHE.pinned.update(stream_key(job["settings"]) for job in self.jobs)
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                list(pool.map(self.prepare, self.jobs))
+        finally:
+            self.running = False
+        summary = self.summary()
+        self.report(f"Batch prepare {'cancelled' if self.cancelled else 'finished'}: {summary['done']} prepared, {summary['skipped']} already ready, {summary['failed']} failed.")
+
+    def prepare(self, job):
+        key = stream_key(job["settings"])
+        if self.cancelled:
+            return
+        if TRANSCODE_CACHE.lookup(key):
+            with self.lock:
+                self.skipped += 1
+            return
+        os.makedirs(TRANSCODE_CACHE.cache_dir, exist_ok=True)
+        part_path = os.path.join(TRANSCODE_CACHE.cache_dir, f"{key}.batch.part")
+        cmd = build_ffmpeg_cmd(dict(job["settings"], offline=True), 0, ["-f", "mp4", "-movflags", "+faststart", "-y", part_path])
+        proc = None
+        while proc is None and not self.cancelled:
+            try:
+                proc = SUPERVISOR.popen(cmd, "batch", stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            except RuntimeError:
+                continue
+            except OSError as e:
+                print(f"Error starting batch encode for {job['title']}: {e}")
+                break
+        if proc is None:
+            with self.lock:
+                self.failed += 0 if self.cancelled else 1
+            return
+
+        progress = ProgressReader(proc)
+        while True:
+            try:
+                proc.wait(timeout=BATCH_REPORT_INTERVAL)
+                break
+            except subprocess.TimeoutExpired:
+                encoded = progress.snapshot()["out_time"]
+                with self.lock:
+                    self.active[job["title"]] = min(99, int(encoded * 100 / job["duration"])) if job["duration"] else 0
+                self.report(self.progress_line())
+
+        with self.lock:
+            self.active.pop(job["title"], None)
+        if proc.returncode == 0 and not self.cancelled:
+            try:
+                TRANSCODE_CACHE.store(key, part_path)
+            except OSError as e:
+                print(f"Could not store batch encode for {job['title']}: {e}")
+                if os.path.exists(part_path):
+                    os.remove(part_path)
+                with self.lock:
+                    self.failed += 1
+                return
+            with self.lock:
+                self.done += 1
+            self.report(self.progress_line())
+            return
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        if not self.cancelled:
+            print(f"Batch encode failed for {job['title']} (exit {proc.returncode})")
+            with self.lock:
+                self.failed += 1
+
+    def progress_line(self):
+        with self.lock:
+            finished = self.done + self.skipped + self.failed
+            active = ", ".join(f"{title} {percent}%" for title, percent in self.active.items())
+        return f"Preparing {finished}/{len(self.jobs)}" + (f" | {active}" if active else "")
+
+    def summary(self):
+        with self.lock:
+            return {"running": self.running, "total": len(self.jobs), "done": self.done, "skipped": self.skipped,
+                    "failed": self.failed, "workers": self.workers, "active": dict(self.active)}
+
+    def cancel(self):
+        self.cancelled = True
+        SUPERVISOR.stop_session("batch")
+
+def subtitle_is_text(sub, source_info):
+    if sub.startswith("internal:"):
+        idx = int(sub.split(":")[1])
+        tracks = (source_info or {}).get("subtitles", [])
+        return idx < len(tracks) and tracks[idx]["codec"] in TEXT_SUBTITLE_CODECS
+    return os.path.splitext(sub)[1].lower() in (".srt", ".ass", ".ssa", ".vtt")
+
+def parse_vtt_time(value):
+    seconds = 0.0
+    for part in value.replace(",", ".").split(":"):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+def format_vtt_time(seconds):
+    ms = int(round(seconds * 1000))
+    h, ms = divmod(ms, 3600000)
+    m, ms = divmod(ms, 60000)
+    sec, ms = divmod(ms, 1000)
+    return f"{h:02d}:{m:02d}:{sec:02d}.{ms:03d}"
+
+def shift_vtt(text, offset):
+    if not offset:
+        return text
+    blocks = text.replace("\r\n", "\n").split("\n\n")
+    shifted = [blocks[0]]
+    for block in blocks[1:]:
+        lines = block.split("\n")
+        timing = next((i for i, line in enumerate(lines) if "-->" in line), None)
+        if timing is None:
+            shifted.append(block)
+            continue
+        start, _, rest = lines[timing].partition("-->")
+        end, _, cue_settings = rest.strip().partition(" ")
+        try:
+            start, end = parse_vtt_time(start.strip()) - offset, parse_vtt_time(end) - offset
+        except ValueError:
+            continue
+        if end <= 0:
+            continue
+        lines[timing] = f"{format_vtt_time(max(start, 0))} --> {format_vtt_time(end)} {cue_settings}".rstrip()
+        shifted.append("\n".join(lines))
+    return "\n\n".join(shifted)
+
+class SubtitleCache:
+    def __init__(self, cache_dir, limit):
+        self.cache_dir = cache_dir
+        self.limit = limit
+        self.tracks = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=1)
+
+    def file_prefix(self, video_file):
+        return hashlib.sha1(json.dumps(file_identity(video_file)).encode()).hexdigest()[:16]
+
+    def extracted_path(self, video_file, sub_index):
+        return os.path.join(self.cache_dir, f"{self.file_prefix(video_file)}-{sub_index}.ass")
+
+    def extracted(self, video_file, sub_index):
+        path = self.extracted_path(video_file, sub_index)
+        return path if os.path.exists(path) else None
+
+    def extract_all(self, video_file):
+        probe = PROBE_CACHE.get(video_file)
+        tracks = [t["sub_index"] for t in (probe or {}).get("subtitles", []) if t["codec"] in TEXT_SUBTITLE_CODECS]
+        tracks = [n for n in tracks if not self.extracted(video_file, n)]
+        if not tracks:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        cmd = ["ffmpeg", "-y", "-v", "error", "-i", video_file]
+        outputs = {n: self.extracted_path(video_file, n) for n in tracks}
+        for n, path in outputs.items():
+            cmd += ["-map", f"0:s:{n}", "-c:s", "ass", "-f", "ass", path + ".tmp"]
+        try:
+            res = SUPERVISOR.run(cmd, "subtitles", "subtitle", timeout=600)
+            if res.returncode == 0:
+                for path in outputs.values():
+                    os.replace(path + ".tmp", path)
+                print(f"Extracted {len(outputs)} subtitle track(s) from {os.path.basename(video_file)}")
+        except Exception as e:
+            print(f"Error extracting subtitles: {e}")
+        finally:
+            for path in outputs.values():
+                if os.path.exists(path + ".tmp"): os.remove(path + ".tmp")
+        evict_cache(self.cache_dir, self.limit, keep=tuple(os.path.basename(p) for p in outputs.values()))
+
+    def warm(self, paths):
+        for path in paths:
+            self.pool.submit(self.extract_all, path)
+
+    def register(self, video_file, sub):
+        source = sub if sub.startswith("internal:") else file_identity(sub)
+        track_id = hashlib.sha1(json.dumps([file_identity(video_file), source]).encode()).hexdigest()[:16]
+        self.tracks[track_id] = (video_file, sub)
+        return track_id
+
+    def entry_path(self, track_id):
+        return os.path.join(self.cache_dir, f"{track_id}.vtt")
+
+    def get(self, track_id):
+        # Ids come straight from request paths; only serve ones we handed out.
+        source = self.tracks.get(track_id)
+        if source is None:
+            return None
+        path = self.entry_path(track_id)
+        with self.lock:
+            lock = self.locks.setdefault(track_id, threading.Lock())
+        with lock:
+            if not os.path.exists(path):
+                self.convert(*source, path)
+        return path if os.path.exists(path) else None
+
+    def convert(self, video_file, sub, path):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = path + ".tmp"
+        extracted = self.extracted(video_file, sub.split(":")[1]) if sub.startswith("internal:") else None
+        if extracted:
+            cmd = ["ffmpeg", "-y", "-v", "error", "-i", extracted, "-f", "webvtt", tmp_path]
+        elif sub.startswith("internal:"):
+            cmd = ["ffmpeg", "-y", "-v", "error", "-i", video_file, "-map", f"0:s:{sub.split(':')[1]}", "-f", "webvtt", tmp_path]
+        else:
+            cmd = ["ffmpeg", "-y", "-v", "error", "-i", sub, "-f", "webvtt", tmp_path]
+        try:
+            res = SUPERVISOR.run(cmd, "subtitles", "subtitle", timeout=300)
+            if res.returncode == 0:
+                os.replace(tmp_path, path)
+                print(f"Subtitles converted to WebVTT: {os.path.basename(path)}")
+        except Exception as e:
+            print(f"Error converting subtitles: {e}")
+        finally:
+            if os.path.exists(tmp_path): os.remove(tmp_path)
+        evict_cache(self.cache_dir, self.limit, keep=(os.path.basename(path),))
+
+SUBTITLE_CACHE = SubtitleCache(SUBTITLE_CACHE_DIR, SUBTITLE_CACHE_LIMIT)
+
+class ThumbnailCache:
+    def __init__(self, cache_dir, limit):
+        self.cache_dir = cache_dir
+        self.limit = limit
+        self.sources = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=2)
+
+    def register(self, path):
+        thumb_id = hashlib.sha1(json.dumps(file_identity(path)).encode()).hexdigest()[:16]
+        self.sources[thumb_id] = path
+        return thumb_id
+
+    def entry_path(self, thumb_id):
+        return os.path.join(self.cache_dir, f"{thumb_id}.jpg")
+
+    def ready(self, path):
+        thumb_id = self.register(path)
+        return thumb_id if os.path.exists(self.entry_path(thumb_id)) else None
+
+    def get(self, thumb_id):
+        # Ids come straight from request paths; only serve ones we handed out.
+        if thumb_id not in self.sources:
+            return None
+        path = self.entry_path(thumb_id)
+        with self.lock:
+            lock = self.locks.setdefault(thumb_id, threading.Lock())
+        with lock:
+            if not os.path.exists(path):
+                self.generate(self.sources[thumb_id], path)
+        return path if os.path.exists(path) else None
+
+    def generate(self, source, path):
+        probe = PROBE_CACHE.get(source) or {}
+        scale = ["-vf", "scale='min(640,iw)':-2", "-q:v", "3", "-f", "image2", path + ".tmp"]
+        if probe.get("cover_art"):
+            attempts = [["-i", source, "-map", "0:v:0", "-frames:v", "1"]]
+        elif probe.get("video"):
+            offset = min(THUMB_OFFSET, probe.get("duration", 0) * 0.1) if probe.get("duration") else THUMB_OFFSET
+            attempts = [["-ss", str(offset), "-i", source, "-map", "0:v:0", "-frames:v", "1"], ["-i", source, "-map", "0:v:0", "-frames:v", "1"]]
+        else:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        try:
+            for args in attempts:
+                res = SUPERVISOR.run(["ffmpeg", "-y", "-v", "error"] + args + scale, "thumbnail", "thumbnail", timeout=30)
+                if res.returncode == 0 and os.path.exists(path + ".tmp") and os.path.getsize(path + ".tmp"):
+                    os.replace(path + ".tmp", path)
+                    break
+        except Exception as e:
+            print(f"Error generating thumbnail for {source}: {e}")
+        finally:
+            if os.path.exists(path + ".tmp"): os.remove(path + ".tmp")
+        evict_cache(self.cache_dir, self.limit, keep=(os.path.basename(path),))
+
+    def warm(self, paths):
+        for path in paths:
+            self.pool.submit(self.get, self.register(path))
+
+THUMBNAIL_CACHE = ThumbnailCache(THUMB_CACHE_DIR, THUMB_CACHE_LIMIT)
+
+HLS_SESSIONS = {}
+HLS_SESSIONS_LOCK = threading.Lock()
+
+def open_hls_session(settings, duration, keep=()):
+    key = stream_key(settings)
+    with HLS_SESSIONS_LOCK:
+        for other_key, other in list(HLS_SESSIONS.items()):
+            if other_key != key and other_key not in keep:
+                other.stop()
+                del HLS_SESSIONS[other_key]
+        if key not in HLS_SESSIONS:
+            HLS_SESSIONS[key] = HlsSession(settings, duration)
+        return HLS_SESSIONS[key]
+
+STREAM_SPECS = OrderedDict()
+STREAM_SPECS_LIMIT = 16
+
+def register_stream(settings, seek_time=0):
+    # Keep the keyframe-snapped fraction: truncating it starts ffmpeg before the keyframe and shifts positions and cues.
+    seek_time = round(float(seek_time), 3)
+    token = f"{stream_key(settings)}-{seek_time:.3f}"
+    STREAM_SPECS[token] = {"settings": settings, "seek_time": seek_time}
+    STREAM_SPECS.move_to_end(token)
+    while len(STREAM_SPECS) > STREAM_SPECS_LIMIT:
+        STREAM_SPECS.popitem(last=False)
+    return token
+
+class Mp4BoxSplitter:
+    def __init__(self):
+        self.remaining = 0
+        self.pending = b""
+
+    def feed(self, data):
+        data = self.pending + data
+        self.pending = b""
+        pieces = []
+        cut, cut_type = 0, None
+        pos = 0
+        while pos < len(data):
+            if self.remaining:
+                step = min(self.remaining, len(data) - pos)
+                pos += step
+                self.remaining -= step
+                continue
+            if len(data) - pos < 8:
+                self.pending = data[pos:]
+                break
+            size = int.from_bytes(data[pos:pos+4], "big")
+            box_type = data[pos+4:pos+8]
+            if size == 1:
+                if len(data) - pos < 16:
+                    self.pending = data[pos:]
+                    break
+                size = int.from_bytes(data[pos+8:pos+16], "big")
+            if size < 8:
+                size = 1 << 62
+            if box_type == b"moof":
+                if pos > cut:
+                    pieces.append((data[cut:pos], cut_type))
+                cut, cut_type = pos, box_type
+            self.remaining = size
+        end = len(data) - len(self.pending)
+        if end > cut:
+            pieces.append((data[cut:end], cut_type))
+        return pieces
+
+class SharedTranscode:
+    def __init__(self, token, settings, seek_time, prestart=False):
+        self.token = token
+        self.prestart = prestart
+        self.key = stream_key(settings)
+        self.cond = threading.Condition()
+        self.init = b""
+        self.init_ready = False
+        self.chunks = deque()
+        self.next_seq = 0
+        self.buffered = 0
+        self.clients = 0
+        self.attached = False
+        self.done = False
+        self.closed = False
+        self.cursors = {}
+        self.progressed = {}
+        self.skips = 0
+        self.bytes_sent = 0
+
+        cmd = build_ffmpeg_cmd(settings, seek_time, PROGRESSIVE_OUTPUT_ARGS)
+        # A prestart pauses after its first fragments and only takes an admission slot once a client attaches.
+        self.proc = SUPERVISOR.popen(
+             cmd, token, deferred=prestart,
+             stdout=subprocess.PIPE, 
+             stderr=subprocess.PIPE, 
+             bufsize=0
+        )
+        tune_pipe(self.proc.stdout)
+        self.progress = ProgressReader(self.proc)
+        TELEMETRY.session_started()
+
+        self.cache_file = self.part_path = None
+        if seek_time == 0 and os.path.isfile(settings["video_file"]):
+            self.cache_file, self.part_path = TRANSCODE_CACHE.open_part(self.key)
+
+        threading.Thread(target=self.reader, daemon=True).start()
+
+    def reader(self):
+        splitter = Mp4BoxSplitter()
+        try:
+            while not self.closed:
+                data = self.proc.stdout.read(RELAY_CHUNK)
+                if not data: break
+                if self.cache_file: self.cache_file.write(data)
+                for piece, box_type in splitter.feed(data):
+                    self.append(piece, box_type == b"moof")
+        except (OSError, ValueError):
+            pass
+        completed = not self.closed and self.proc.wait() == 0
+        with self.cond:
+            self.done = True
+            self.init_ready = True
+            self.cond.notify_all()
+
+        if self.cache_file:
+            self.cache_file.close()
+            if completed:
+                TRANSCODE_CACHE.commit(self.key, self.part_path)
+            else:
+                TRANSCODE_CACHE.discard(self.part_path)
+
+    def append(self, piece, fragment_start):
+        with self.cond:
+            if not self.init_ready and not fragment_start:
+                self.init += piece
+                return
+            self.init_ready = True
+            while self.prestart and not self.attached and not self.closed and self.buffered >= SHARED_PRESTART_BUFFER:
+                self.cond.wait(1)
+            while self.buffered + len(piece) > SHARED_BUFFER_LIMIT and self.chunks:
+                if not self.closed and not self.releasable(self.chunks[0][0]):
+                    self.cond.wait(1)
+                    continue
+                _, old, _ = self.chunks.popleft()
+                self.buffered -= len(old)
+            self.chunks.append((self.next_seq, piece, fragment_start))
+            self.next_seq += 1
+            self.buffered += len(piece)
+            self.cond.notify_all()
+
+    def releasable(self, seq):
+        """Whether fragment seq can leave the buffer.
+
+        A lone reader paces the encoder. With several, the ones still on seq are skipped ahead once they trail the
+        fastest reader by SHARED_MAX_LAG or stop reading for SHARED_STALL_TIMEOUT, so one slow room can't starve the rest."""
+        if not self.cursors or self.clients > len(self.cursors):
+            return False
+        holding = [client_id for client_id, cursor in self.cursors.items() if cursor <= seq]
+        if not holding:
+            return True
+        fastest = max(self.cursors.values())
+        if fastest <= seq:
+            return False
+        lag = sum(len(piece) for n, piece, _ in self.chunks if n < fastest)
+        now = time.monotonic()
+        return all(lag > SHARED_MAX_LAG or now - self.progressed[client_id] > SHARED_STALL_TIMEOUT for client_id in holding)
+
+    def stream_to(self, sock, started=None):
+        started = started or time.perf_counter()
+        tune_socket(sock)
+        client_id = object()
+        with self.cond:
+            admit = self.prestart and not self.attached
+            self.attached = True
+        if admit and not SUPERVISOR.admit(self.proc):
+            print(f"No free encoder slot for pre-started {self.token}; continuing anyway")
+        with self.cond:
+            self.clients += 1
+            self.cond.notify_all()
+        try:
+            with self.cond:
+                while not self.init_ready:
+                    self.cond.wait(1)
+                init = self.init
+            sock.sendall(init)
+            TELEMETRY.first_byte(time.perf_counter() - started)
+
+            cursor = None
+            while True:
+                with self.cond:
+                    while not self.done and (cursor is not None and cursor >= self.next_seq or not self.chunks):
+                        self.cond.wait(1)
+                    if not self.chunks:
+                        break
+                    oldest = self.chunks[0][0]
+                    if cursor is None or cursor < oldest:
+                        starts = [seq for seq, _, start in self.chunks if start and seq >= (cursor or 0)]
+                        if cursor is not None:
+                            self.skips += 1
+                            print(f"Slow client on {self.token} skipped ahead from {cursor}")
+                        cursor = starts[0] if starts else self.next_seq
+                    batch, size = [], 0
+                    for seq, piece, _ in itertools.islice(self.chunks, cursor - oldest, None):
+                        if batch and size + len(piece) > SHARED_SEND_BATCH:
+                            break
+                        batch.append(piece)
+                        size += len(piece)
+                    if not batch and self.done:
+                        break
+                    # The cursor stays on the batch until it is sent, so the producer can't drop it underneath us.
+                    self.cursors[client_id] = cursor
+                    self.progressed.setdefault(client_id, time.monotonic())
+                self.bytes_sent += send_pieces(sock, batch)
+                cursor += len(batch)
+                with self.cond:
+                    self.cursors[client_id] = cursor
+                    self.progressed[client_id] = time.monotonic()
+                    self.cond.notify_all()
+        finally:
+            with self.cond:
+                self.clients -= 1
+                self.cursors.pop(client_id, None)
+                self.progressed.pop(client_id, None)
+                self.cond.notify_all()
+                idle = self.clients == 0
+            if idle:
+                timer = threading.Timer(SHARED_IDLE_TIMEOUT, self.stop_if_idle)
+                timer.daemon = True
+                timer.start()
+
+    def stats(self):
+        with self.cond:
+            lag = 0
+            if self.cursors:
+                slowest = min(self.cursors.values())
+                lag = sum(len(piece) for seq, piece, _ in self.chunks if seq >= slowest)
+            running = self.proc.poll() is None
+            clients = self.clients
+        stats = self.progress.snapshot()
+        stats.update(speed=stats["speed"] if running else None, lag_ratio=lag / SHARED_BUFFER_LIMIT, skips=self.skips, clients=clients, bytes_sent=self.bytes_sent, running=running)
+        return stats
+
+    def stop_if_idle(self):
+        with self.cond:
+            if self.clients:
+                return
+        release_shared_transcode(self)
+
+    def stop(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        stop_process(self.proc)
+
+SHARED_TRANSCODES = {}
+SHARED_TRANSCODES_LOCK = threading.Lock()
+
+def shared_usable(shared):
+    return shared is not None and not shared.closed and not (shared.done and not shared.chunks)
+
+def get_shared_transcode(token, settings, seek_time, prestart=False):
+    with SHARED_TRANSCODES_LOCK:
+        shared = SHARED_TRANSCODES.get(token)
+        if shared_usable(shared):
+            return shared
+    # Admission may block until another encoder exits, so don't hold the registry lock meanwhile.
+    created = SharedTranscode(token, settings, seek_time, prestart)
+    with SHARED_TRANSCODES_LOCK:
+        shared = SHARED_TRANSCODES.get(token)
+        if not shared_usable(shared):
+            SHARED_TRANSCODES[token] = created
+            return created
+    created.stop()
+    return shared
+
+def release_shared_transcode(shared):
+    with SHARED_TRANSCODES_LOCK:
+        if SHARED_TRANSCODES.get(shared.token) is shared:
+            del SHARED_TRANSCODES[shared.token]
+    shared.stop()
+
+def prestart_stream(token):
+    spec = STREAM_SPECS.get(token)
+    if spec is None:
+        return
+    for other in list(SHARED_TRANSCODES.values()):
+        if other.token != token and not other.attached:
+            release_shared_transcode(other)
+    get_shared_transcode(token, spec["settings"], spec["seek_time"], prestart=True)
+    print(f"Pre-started transcode for {token}")
+
+def cancel_stream(token):
+    shared = SHARED_TRANSCODES.get(token)
+    if shared is not None:
+        release_shared_transcode(shared)
+        print(f"Cancelled superseded transcode {token}")
+    SUPERVISOR.stop_session(token)
+
+def stream_stats(request):
+    if not request:
+        return None
+    if request.get('token') in SHARED_TRANSCODES:
+        return SHARED_TRANSCODES[request['token']].stats()
+    if request['native_seek_key'] in HLS_SESSIONS:
+        return HLS_SESSIONS[request['native_seek_key']].stats()
+    return None
+
+METRICS = [
+    ("encode_fps", "gauge", "Current encode rate in frames per second", "fps"),
+    ("encode_speed", "gauge", "Encode speed relative to realtime", "speed"),
+    ("encoded_frames_total", "counter", "Frames written by the encoder", "frames"),
+    ("dropped_frames_total", "counter", "Frames dropped by ffmpeg", "dropped_frames"),
+    ("duplicated_frames_total", "counter", "Frames duplicated by ffmpeg", "duplicated_frames"),
+    ("encoded_bytes_total", "counter", "Bytes produced by the encoder", "output_bytes"),
+    ("encoded_seconds", "gauge", "Media time encoded so far", "out_time"),
+    ("relayed_bytes_total", "counter", "Bytes relayed to HTTP clients", "bytes_sent"),
+    ("clients", "gauge", "HTTP clients attached to the session", "clients"),
+    ("reader_lag_ratio", "gauge", "Slowest reader lag as a fraction of the replay buffer", "lag_ratio"),
+    ("reader_skips_total", "counter", "Times a slow reader skipped ahead", "skips"),
+]
+
+def render_metrics():
+    sessions = [("progressive", token, shared.stats()) for token, shared in list(SHARED_TRANSCODES.items())]
+    sessions += [("hls", key, session.stats()) for key, session in list(HLS_SESSIONS.items())]
+    lines = [
+        "# HELP sakuracast_sessions_started_total Transcode sessions started",
+        "# TYPE sakuracast_sessions_started_total counter",
+        f"sakuracast_sessions_started_total {TELEMETRY.sessions_started}",
+        "# HELP sakuracast_relayed_bytes_all_total Bytes relayed to HTTP clients across all sessions",
+        "# TYPE sakuracast_relayed_bytes_all_total counter",
+        f"sakuracast_relayed_bytes_all_total {TELEMETRY.bytes_relayed}",
+        "# HELP sakuracast_relay_bytes_total Bytes relayed to HTTP clients by copy method",
+        "# TYPE sakuracast_relay_bytes_total counter",
+    ]
+    lines += [f'sakuracast_relay_bytes_total{{method="{method}"}} {size}' for method, size in TELEMETRY.relay_bytes.items()]
+    lines += [
+        "# HELP sakuracast_relay_send_seconds_total Time spent blocked writing buffered and sendfile data to clients",
+        "# TYPE sakuracast_relay_send_seconds_total counter",
+        f"sakuracast_relay_send_seconds_total {TELEMETRY.relay_send_seconds:g}",
+        "# HELP sakuracast_relay_first_byte_seconds Delay between a media response's headers and its first body byte",
+        "# TYPE sakuracast_relay_first_byte_seconds summary",
+        f"sakuracast_relay_first_byte_seconds_sum {TELEMETRY.first_byte_seconds:g}",
+        f"sakuracast_relay_first_byte_seconds_count {TELEMETRY.first_byte_count}",
+    ]
+    for name, kind, help_text, field in METRICS:
+        lines.append(f"# HELP sakuracast_{name} {help_text}")
+        lines.append(f"# TYPE sakuracast_{name} {kind}")
+        for mode, session_id, stats in sessions:
+            value = stats.get(field)
+            if value is not None:
+                lines.append(f'sakuracast_{name}{{session="{session_id}",mode="{mode}"}} {float(value):g}')
+
+    processes = SUPERVISOR.snapshot()
+    encoders = sum(1 for p in processes if p["kind"] == "encoder")
+    lines += [
+        "# HELP sakuracast_encoders_running Encoder processes holding an admission slot",
+        "# TYPE sakuracast_encoders_running gauge",
+        f"sakuracast_encoders_running {encoders}",
+        "# HELP sakuracast_encoders_max Admission limit for concurrent encoders",
+        "# TYPE sakuracast_encoders_max gauge",
+        f"sakuracast_encoders_max {SUPERVISOR.max_encoders}",
+    ]
+    for name, help_text, field in [("process_cpu_seconds_total", "CPU time used by a child process", "cpu_seconds"), ("process_rss_bytes", "Resident memory of a child process", "rss_bytes")]:
+        lines.append(f"# HELP sakuracast_{name} {help_text}")
+        lines.append(f"# TYPE sakuracast_{name} {'counter' if name.endswith('_total') else 'gauge'}")
+        for p in processes:
+            if p[field] is not None:
+                lines.append(f'sakuracast_{name}{{pid="{p["pid"]}",session="{p["session"]}",kind="{p["kind"]}"}} {float(p[field]):g}')
+    return "\n".join(lines) + "\n"
+
+def stop_shared_transcodes():
+    for shared in list(SHARED_TRANSCODES.values()):
+        release_shared_transcode(shared)
+
 class FFmpegStreamHandler(http.server.BaseHTTPRequestHandler):
     video_file = None
+    audio_file = None
+    audio_headers = {}
     subtitle_file = None
     seek_time = 0 
     headers_dict = {}
@@ -58,276 +2100,1510 @@ class FFmpegStreamHandler(http.server.BaseHTTPRequestHandler):
     crop_left = 0
     crop_right = 0
 
-    def do_GET(self):
+    stream_mode = "Progressive"
+    duration = 0
+    source_info = None
+    device_model = None
+    rate_mode = "Adaptive"
+    rate_rung = 0
+    subtitle_mode = "Sidecar"
+    engine = None
+
+    @classmethod
+    def current_settings(cls):
+        settings = {
+            "video_file": cls.video_file,
+            "audio_file": cls.audio_file,
+            "subtitle_file": cls.subtitle_file,
+            "headers_dict": dict(cls.headers_dict),
+            "audio_headers": dict(cls.audio_headers),
+            "encoder": cls.encoder,
+            "hw_args": list(cls.hw_args),
+            "aspect_ratio": cls.aspect_ratio,
+            "resolution": cls.resolution,
+            "fps": cls.fps,
+            "crop_top": cls.crop_top,
+            "crop_bottom": cls.crop_bottom,
+            "crop_left": cls.crop_left,
+            "crop_right": cls.crop_right,
+            "passthrough": "transcode",
+            "rung": cls.rate_rung,
+        }
+        return cls.finish_settings(settings, cls.source_info)
+
+    @classmethod
+    def finish_settings(cls, settings, source_info):
+        sub = settings["subtitle_file"]
+        settings["sidecar_subtitle"] = None
+        if sub and cls.subtitle_mode == "Sidecar" and subtitle_is_text(sub, source_info):
+            settings["sidecar_subtitle"] = sub
+            settings["subtitle_file"] = None
+        settings["source_info"] = source_info
+        settings["passthrough"] = cls.passthrough_for(settings, source_info)
+        settings["audio_only"] = select_audio_output(settings, source_info)
+        return settings
+
+    @classmethod
+    def passthrough_for(cls, settings, source_info):
+        if cls.stream_mode != "Progressive":
+            return "transcode"
+        return select_passthrough(source_info, settings, cls.device_model)
+
+    def send_file(self, path, content_type):
+        size = os.path.getsize(path)
+        byte_range = parse_range(self.headers.get("Range"), size)
+        if byte_range is False:
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{size}")
+            self.end_headers()
+            return 0
+
+        start, end = byte_range or (0, size - 1)
+        self.send_response(206 if byte_range else 200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end - start + 1))
+        if byte_range:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.end_headers()
+
+        with open(path, "rb") as f:
+            return relay_file(f, self.connection, start, end - start + 1)
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def serve_api(self, method, clean_path):
+        if self.engine is None:
+            self.send_json({"error": "no playback engine running"}, 503)
+            return
+        # A JSON content type can't be sent cross-origin without a preflight, which this server never answers.
+        if method == "POST" and self.headers.get("Content-Type", "").split(";")[0].strip().lower() != "application/json":
+            self.send_json({"error": "POST requests must use Content-Type: application/json"}, 415)
+            return
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            body = json.loads(self.rfile.read(length)) if length else {}
+            if not isinstance(body, dict):
+                raise ValueError("request body must be a JSON object")
+            result = self.engine.api(method, clean_path[len("/api/"):].strip("/"), body)
+        except (ValueError, TypeError) as e:
+            self.send_json({"error": str(e)}, 400)
+            return
+        except Exception as e:
+            print(f"Error in API call {clean_path}: {e}")
+            self.send_json({"error": str(e)}, 500)
+            return
+        if result is None:
+            self.send_json({"error": f"unknown endpoint {method} {clean_path}"}, 404)
+        else:
+            self.send_json(result)
+
+    def do_POST(self):
         clean_path = self.path.split('?')[0]
+        if clean_path.startswith("/api/"):
+            self.serve_api("POST", clean_path)
+        else:
+            self.send_error(404)
+
+    def serve_audio(self):
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        token = query.get("id", [""])[0]
+        spec = STREAM_SPECS.get(token)
+        if spec is None or not spec["settings"].get("audio_only"):
+            self.send_error(404)
+            return
+        settings, seek_time = spec["settings"], spec["seek_time"]
+        output = settings["audio_only"]
+        if output["mode"] == "direct":
+            try:
+                self.send_file(settings["video_file"], output["mime"])
+            except (ConnectionResetError, BrokenPipeError):
+                pass
+            return
+
+        try:
+            proc = SUPERVISOR.popen(build_audio_cmd(settings, seek_time), token, kind="audio", stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=0)
+        except OSError as e:
+            print(f"Error starting audio stream: {e}")
+            self.send_error(500)
+            return
+        ProgressReader(proc)
+        self.send_response(200)
+        self.send_header("Content-Type", output["mime"])
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.end_headers()
+        try:
+            relay_pipe(proc.stdout, self.connection)
+        except (ConnectionResetError, BrokenPipeError):
+            pass
+        finally:
+            stop_process(proc)
+
+    def serve_thumbnail(self, thumb_id):
+        path = THUMBNAIL_CACHE.get(thumb_id)
+        if path is None:
+            self.send_error(404)
+            return
+        st = os.stat(path)
+        etag = f'"{thumb_id}-{int(st.st_mtime)}-{st.st_size}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(st.st_size))
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", "public, max-age=86400")
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.end_headers()
+        try:
+            with open(path, "rb") as f:
+                shutil.copyfileobj(f, self.wfile)
+        except (ConnectionResetError, BrokenPipeError):
+            pass
+
+    def serve_subtitles(self, track_id):
+        path = SUBTITLE_CACHE.get(track_id)
+        if path is None:
+            self.send_error(404)
+            return
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        try:
+            offset = float(query.get("offset", ["0"])[0])
+        except ValueError:
+            offset = 0
+        with open(path, encoding="utf-8", errors="replace") as f:
+            body = shift_vtt(f.read(), offset).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/vtt; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def serve_hls(self, clean_path):
+        parts = clean_path.split("/")
+        session = HLS_SESSIONS.get(parts[2]) if len(parts) == 4 else None
+        if session is None:
+            self.send_error(404)
+            return
 
-        if clean_path == "/thumb.jpg":
-            thumb_path = os.path.join(SCRIPT_DIR, "thumb.jpg")
-            if os.path.exists(thumb_path):
+        name = parts[3]
+        try:
+            if name == "index.m3u8":
+                body = session.playlist().encode()
                 self.send_response(200)
-                self.send_header("Content-Type", "image/jpeg")
+                self.send_header("Content-Type", HLS_MIME)
+                self.send_header("Content-Length", str(len(body)))
                 self.send_header("Access-Control-Allow-Origin", "*")
                 self.end_headers()
-                with open(thumb_path, "rb") as f:
-                    self.wfile.write(f.read())
-                return
+                self.wfile.write(body)
+            elif name == "init.mp4":
+                path = session.get_init()
+                if path: session.sent(self.send_file(path, VIDEO_MIME))
+                else: self.send_error(404)
+            elif name.startswith("seg_") and name.endswith(".m4s"):
+                path = session.get_segment(int(name[4:-4]))
+                if path: session.sent(self.send_file(path, VIDEO_MIME))
+                else: self.send_error(404)
             else:
                 self.send_error(404)
-                return
+        except (ConnectionResetError, BrokenPipeError):
+            pass
+        except ValueError:
+            self.send_error(404)
+        except RuntimeError as e:
+            print(e)
+            self.send_error(503)
+
+    def do_GET(self):
+        clean_path = self.path.split('?')[0]
+
+        if clean_path.startswith("/thumb/") and clean_path.endswith(".jpg"):
+            self.serve_thumbnail(clean_path[len("/thumb/"):-len(".jpg")])
+            return
+
+        if clean_path == "/metrics":
+            body = render_metrics().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        if clean_path.startswith("/api/"):
+            self.serve_api("GET", clean_path)
+            return
+
+        if clean_path.startswith("/hls/"):
+            self.serve_hls(clean_path)
+            return
+
+        if clean_path == "/audio":
+            self.serve_audio()
+            return
+
+        if clean_path.startswith("/subs/") and clean_path.endswith(".vtt"):
+            self.serve_subtitles(clean_path[len("/subs/"):-len(".vtt")])
+            return
 
         if not clean_path.startswith("/stream.mp4"):
             self.send_error(404)
             return
-        
-        sub_filter = ""
-        sub_file = self.subtitle_file
-        
-        if sub_file:
-            offset = self.seek_time
-            crt_style = ("force_style='Alignment=2,Outline=1,Shadow=1,BorderStyle=4,""BackColour=&H80000000,Spacing=0.2,MarginV=15,FontSize=20,Bold=1'")
-            
-            if sub_file.startswith("internal:"):
-                stream_idx = sub_file.split(":")[1]
-                escaped_vid = self.video_file.replace("\\", "/").replace(":", "\\:")
-                sub_filter = f"setpts=PTS+{offset}/TB,subtitles='{escaped_vid}':si={stream_idx}:{crt_style},setpts=PTS-{offset}/TB,"
-            elif os.path.exists(sub_file):
-                escaped_path = sub_file.replace("\\", "/").replace(":", "\\:")
-                sub_filter = f"setpts=PTS+{offset}/TB,subtitles='{escaped_path}':{crt_style},setpts=PTS-{offset}/TB,"
-
-        res = FFmpegStreamHandler.resolution
-        target_dar = self.aspect_ratio
-        res_w, res_h = res.split('x')
-
-        fps_val = FFmpegStreamHandler.fps
-        fps_filter_str = f",fps={fps_val}" if fps_val != "Original" else ""
-        
-        fps_output_args = ["-r", fps_val] if fps_val != "Original" else []
-
-        ct = self.crop_top
-        cb = self.crop_bottom
-        cl = self.crop_left
-        cr = self.crop_right
-        crop_filter = f"crop=iw-{cl}-{cr}:ih-{ct}-{cb}:{cl}:{ct},"
-
-        if "vaapi" in self.encoder:
-            v_filter = f"format=nv12,{crop_filter}{sub_filter}hwupload,scale_vaapi=w={res_w}:h={res_h},setsar=1,setdar={target_dar}{fps_filter_str}"
-        elif "videotoolbox" in self.encoder:
-            v_filter = f"{crop_filter}{sub_filter}scale={res_w}:{res_h},setsar=1,setdar={target_dar},format=yuv420p{fps_filter_str}"
-        else:
-            v_filter = f"{crop_filter}{sub_filter}scale={res_w}:{res_h},setsar=1,setdar={target_dar}{fps_filter_str}"
-
-        extra_input_args = []
-        if self.headers_dict:
-            header_str = "".join([f"{k}: {v}\r\n" for k, v in self.headers_dict.items()])
-            
-            extra_input_args = [
-                "-headers", header_str,
-                "-reconnect", "1",
-                "-reconnect_streamed", "1",
-                "-reconnect_delay_max", "5"
-            ]
-
-        ffmpeg_cmd = [
-            "ffmpeg", 
-            "-protocol_whitelist", "file,http,https,tcp,tls,crypto,data",
-            "-ss", str(self.seek_time)
-        ] + self.hw_args + extra_input_args + [
-            "-i", self.video_file,
-            "-vf", v_filter,
-            "-af", "aresample=async=1",
-            "-c:v", self.encoder,
-        ] + fps_output_args + [
-            "-preset", "ultrafast" if "libx264" in self.encoder else "fast",
-            "-tune", "zerolatency",
-            "-c:a", "aac", "-b:a", "128k",
-            "-f", "mp4", 
-            "-movflags", "frag_keyframe+empty_moov+default_base_moof",
-            "pipe:1"
-        ]
+
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        token = query.get("id", [""])[0]
+        spec = STREAM_SPECS.get(token)
+        settings = spec["settings"] if spec else self.current_settings()
+        seek_time = spec["seek_time"] if spec else self.seek_time
+
+        key = stream_key(settings)
+        cached = TRANSCODE_CACHE.lookup(key) if seek_time == 0 else None
+        if cached:
+            try:
+                self.send_file(cached, VIDEO_MIME)
+            except (ConnectionResetError, BrokenPipeError):
+                pass
+            return
+
+        if not spec:
+            token = register_stream(settings, seek_time)
+        try:
+            shared = get_shared_transcode(token, settings, seek_time)
+        except RuntimeError as e:
+            print(e)
+            self.send_error(503)
+            return
 
         self.send_response(200)
         self.send_header("Content-Type", VIDEO_MIME)
         self.send_header("Access-Control-Allow-Origin", "*")
         self.end_headers()
 
-        proc = subprocess.Popen(
-             ffmpeg_cmd, 
-             stdout=subprocess.PIPE, 
-             stderr=subprocess.DEVNULL, 
-             bufsize=10**6
-        )
+        try:
+            shared.stream_to(self.connection)
+        except (ConnectionResetError, BrokenPipeError):
+            pass
 
+class QueueEntry:
+    """One queued item: a local path or a web URL, plus the title/duration its source already told us."""
+    __slots__ = ("path", "url", "title", "duration", "thumbnail")
+
+    def __init__(self, path=None, url=None, title=None, duration=0, thumbnail=None):
+        self.path = path
+        self.url = url
+        self.title = title
+        self.duration = duration
+        self.thumbnail = thumbnail
+
+    def label(self):
+        if self.url:
+            return f"[URL] {self.title or 'Web Video'}"
+        return self.title or os.path.basename(self.path)
+
+    def row(self):
+        return [self.path, self.url, self.title, self.duration, self.thumbnail]
+
+def parse_m3u(path, batch=PLAYLIST_BATCH):
+    """Yields lists of QueueEntry from an M3U/M3U8 playlist, resolving relative paths against the playlist's folder."""
+    base = os.path.dirname(os.path.abspath(path))
+    entries = []
+    title, duration = None, 0
+    with open(path, encoding="utf-8-sig", errors="replace") as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("#EXTINF:"):
+                info, _, name = line[8:].partition(",")
+                try:
+                    duration = max(0, float(info.split()[0]))
+                except (ValueError, IndexError):
+                    duration = 0
+                title = name.strip() or None
+                continue
+            if not line or line.startswith("#"):
+                continue
+            if line.lower().startswith("file://"):
+                line = urllib.request.url2pathname(urllib.parse.urlparse(line).path)
+            if "://" in line:
+                entries.append(QueueEntry(url=line, title=title or line, duration=duration))
+            else:
+                if os.sep == "/":
+                    line = line.replace("\\", "/")
+                entries.append(QueueEntry(path=os.path.normpath(os.path.join(base, line)), title=title, duration=duration))
+            title, duration = None, 0
+            if len(entries) >= batch:
+                yield entries
+                entries = []
+    if entries:
+        yield entries
+
+class PlayQueue:
+    """The play queue: QueueEntry records behind a lock, written to disk shortly after each change."""
+    def __init__(self, path=QUEUE_PATH):
+        self.path = path
+        self.entries = deque()
+        self.lock = threading.Lock()
+        self.save_timer = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, index):
+        with self.lock:
+            return self.entries[index]
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.entries))
+
+    def window(self, start, count):
+        with self.lock:
+            return list(itertools.islice(self.entries, start, start + count))
+
+    def extend(self, entries):
+        with self.lock:
+            self.entries.extend(entries)
+        self.schedule_save()
+
+    def popleft(self):
+        with self.lock:
+            entry = self.entries.popleft()
+        self.schedule_save()
+        return entry
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+        self.schedule_save()
+
+    def schedule_save(self):
+        if not self.path:
+            return
+        with self.lock:
+            if self.save_timer:
+                return
+            self.save_timer = threading.Timer(QUEUE_SAVE_DELAY, self.save)
+            self.save_timer.daemon = True
+            self.save_timer.start()
+
+    def save(self):
+        with self.lock:
+            if self.save_timer:
+                self.save_timer.cancel()
+            self.save_timer = None
+            rows = [entry.row() for entry in self.entries]
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path + ".tmp", "w") as f:
+                json.dump(rows, f, separators=(",", ":"))
+            os.replace(self.path + ".tmp", self.path)
+        except OSError as e:
+            print(f"Error saving queue: {e}")
+
+    def restore(self):
+        try:
+            with open(self.path) as f:
+                rows = json.load(f)
+            entries = [QueueEntry(*row) for row in rows]
+        except (OSError, ValueError, TypeError):
+            return 0
+        with self.lock:
+            self.entries.extendleft(reversed(entries))
+        return len(entries)
+
+def cast_model(cast):
+    return getattr(cast.cast_info, 'model_name', getattr(cast, 'model_name', None))
+
+def device_entry(cast):
+    return {"uuid": str(cast.uuid), "name": cast.name, "host": cast.cast_info.host, "port": cast.cast_info.port, "model": cast_model(cast)}
+
+class MediaEvents:
+    """pychromecast media status listener that feeds the engine's playback loop for the active device."""
+    def __init__(self, engine, cast):
+        self.engine = engine
+        self.cast = cast
+
+    def new_media_status(self, status):
+        if self.cast is self.engine.cast_device:
+            self.engine.events.put(("status", status))
+
+    def load_media_failed(self, item, error_code):
+        if self.cast is self.engine.cast_device:
+            self.engine.events.put(("failed", error_code))
+
+class StreamServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+class CastEngine:
+    def __init__(self, port=SERVER_PORT):
+        self.port = port
+        self.server = None
+        self.cast_device = None
+        self.preferred_device = None
+        self.browser = None
+        self.chromecasts = []
+        self.unconfirmed = set()
+        self.queue = PlayQueue()
+        self.queue.restore()
+        self.is_playing = False
+        self.current_video_duration = 0
+        self.position_mark = (0, 0, False)
+        self.seek_target = None
+        self.seek_deadline = 0
+        self.player_state = None
+        self.events = Queue()
+        self.playback_generation = 0
+        self.devices_lock = threading.Lock()
+        self.media_listeners = {}
+        self.batch = None
+        self.batch_thread = None
+        self.native_seek_key = None
+        self.next_prepared = None
+        self.lookahead_generation = 0
+        self.current_request = None
+        self.current_title = ""
+        self.current_metadata = None
+        self.play_serial = itertools.count(1)
+        self.rate_controller = RateController()
+        self.last_telemetry = 0
+        self.status = "Searching..."
+        self.listeners = []
+        self.seek_lock = threading.Lock()
+        self.restart_lock = threading.Lock()
+        self.seek_timer = None
+        self.pending_seek = None
+
+    def emit(self, event, **data):
+        if event == "status":
+            self.status = data["text"]
+        for listener in list(self.listeners):
+            try:
+                listener(event, data)
+            except Exception as e:
+                print(f"Error in {event} listener: {e}")
 
-#        proc = subprocess.Popen(
-#            ffmpeg_cmd, 
-#            stdout=subprocess.PIPE, 
-#            stderr=subprocess.PIPE,
-#            bufsize=10**6
-#        )
+    def set_status(self, text):
+        self.emit("status", text=text)
 
-#        def log_reader(pipe):
-#            with pipe:
-#                for line in iter(pipe.readline, b''):
-#                    print(f"[FFmpeg Log]: {line.decode('utf-8', errors='replace').strip()}")
+    def start(self):
+        self.start_server()
+        self.detect_hardware_acceleration()
+        self.discover_chromecasts()
 
-#        threading.Thread(target=log_reader, args=(proc.stderr,), daemon=True).start()
-        
+    def start_server(self):
+        if self.server:
+            return
+        FFmpegStreamHandler.engine = self
         try:
-            while True:
-                chunk = proc.stdout.read(64*1024)
-                if not chunk: break
-                self.wfile.write(chunk)
-        except (ConnectionResetError, BrokenPipeError):
-            pass
-        finally:
-            proc.terminate()
+            self.server = StreamServer(("0.0.0.0", self.port), FFmpegStreamHandler)
+        except OSError as e:
+            print(f"Could not start server on port {self.port}: {e}")
+            self.set_status(f"Port {self.port} unavailable.")
+            return
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def detect_hardware_acceleration(self, force=False, wait=False):
+        system = platform.system()
+        cached = load_encoder_cache()
+        if cached and cached.get("system") == system and not force:
+            self.apply_encoder(cached["selected"])
+
+        def task():
+            key = encoder_probe_key()
+            if cached and cached.get("key") == key and cached.get("system") == system and not force:
+                return
+            self.set_status("Probing encoders...")
+            data = probe_encoders(system, key)
+            save_encoder_cache(data)
+            for r in data["results"]:
+                print(f"Encoder {r['encoder']}: {'ok' if r['ok'] else 'unavailable'} | frame: {r['frame_time']}s | clip: {r['clip_fps']} fps")
+            self.apply_encoder(data["selected"])
+            STARTUP_PROFILE.mark("encoder probe done")
+        if wait:
+            task()
+        else:
+            threading.Thread(target=task, daemon=True).start()
+
+    def apply_encoder(self, selected):
+        FFmpegStreamHandler.encoder = selected["encoder"]
+        FFmpegStreamHandler.hw_args = list(selected["hw_args"])
+        self.set_status(f"Encoder: {FFmpegStreamHandler.encoder}")
+        print(f"OS: {platform.system()} | Selected: {FFmpegStreamHandler.encoder}")
+
+    def discover_chromecasts(self):
+        def task():
+            import pychromecast
+            import zeroconf
+            from pychromecast.discovery import CastBrowser, SimpleCastListener
+            STARTUP_PROFILE.mark("pychromecast imported")
+            for entry in load_device_cache():
+                try:
+                    cast = pychromecast.get_chromecast_from_host((entry["host"], entry["port"], UUID(entry["uuid"]), entry["model"], entry["name"]))
+                except Exception as e:
+                    print(f"Skipping cached device {entry.get('name')}: {e}")
+                    continue
+                self.unconfirmed.add(cast.uuid)
+                self.add_device(cast, persist=False)
+            STARTUP_PROFILE.mark("cached devices loaded")
+
+            zconf = zeroconf.Zeroconf()
+            def found(uuid, service):
+                info = self.browser.devices.get(uuid)
+                if info:
+                    self.add_device(pychromecast.get_chromecast_from_cast_info(info, zconf))
+            def lost(uuid, service, info):
+                self.remove_device(uuid)
+            self.browser = CastBrowser(SimpleCastListener(found, lost, found), zconf)
+            self.browser.start_discovery()
+            atexit.register(self.browser.stop_discovery)
+        threading.Thread(target=task, daemon=True).start()
+
+    def add_device(self, cast, persist=True):
+        with self.devices_lock:
+            if persist:
+                self.unconfirmed.discard(cast.uuid)
+            index = next((i for i, cc in enumerate(self.chromecasts) if cc.uuid == cast.uuid), None)
+            changed = index is None
+            if index is None:
+                self.chromecasts.append(cast)
+            else:
+                known = self.chromecasts[index]
+                moved = (known.cast_info.host, known.cast_info.port) != (cast.cast_info.host, cast.cast_info.port)
+                if moved and known is not self.cast_device:
+                    self.chromecasts[index] = cast
+                    changed = True
+        if persist:
+            save_device_cache([device_entry(cast)])
+        if not changed:
+            return
+        self.emit("devices", devices=self.device_list())
+        self.set_status(f"Found {len(self.chromecasts)} Chromecast(s).")
+        if self.preferred_device is not None and self.cast_device is None:
+            try:
+                self.select_device(self.preferred_device)
+            except ValueError:
+                pass
+
+    def remove_device(self, uuid):
+        with self.devices_lock:
+            kept = [cc for cc in self.chromecasts if cc.uuid != uuid or cc is self.cast_device]
+            if len(kept) == len(self.chromecasts):
+                return
+            self.chromecasts = kept
+        self.emit("devices", devices=self.device_list())
+        self.set_status(f"Found {len(self.chromecasts)} Chromecast(s).")
+
+    def connect(self, cast):
+        """Waits for the device handshake; a cached device that never answers is dropped from the list and devices.json."""
+        try:
+            cast.wait(timeout=DEVICE_CONNECT_TIMEOUT)
+            if cast.status is not None:
+                return True
+        except Exception as e:
+            print(f"Could not connect to {cast.name}: {e}")
+        if cast.uuid in self.unconfirmed:
+            print(f"Forgetting cached device {cast.name}; it did not answer at {cast.cast_info.host}")
+            forget_cached_device(cast.uuid)
+            with self.devices_lock:
+                self.unconfirmed.discard(cast.uuid)
+                self.chromecasts = [cc for cc in self.chromecasts if cc is not cast]
+                if self.cast_device is cast:
+                    self.cast_device = None
+            try:
+                cast.disconnect(timeout=0)
+            except Exception:
+                pass
+            self.emit("devices", devices=self.device_list())
+        return False
+
+    def device_list(self):
+        return [{"index": i, "name": cc.name, "model": cast_model(cc) or "Unknown"} for i, cc in enumerate(self.chromecasts)]
+
+    def find_device(self, device):
+        if isinstance(device, str) and device.isdigit():
+            device = int(device)
+        if isinstance(device, int):
+            if not 0 <= device < len(self.chromecasts):
+                raise ValueError(f"No Chromecast at index {device}")
+            return self.chromecasts[device]
+        cast = next((cc for cc in self.chromecasts if cc.name == device), None)
+        if cast is None:
+            raise ValueError(f"No Chromecast named {device!r}")
+        return cast
+
+    def select_device(self, device):
+        cast = self.find_device(device)
+        if self.is_playing and cast is not self.cast_device:
+            self.stop_cast()
+        self.cast_device = cast
+        FFmpegStreamHandler.device_model = cast_model(cast)
+        self.prewarm(cast)
+        self.emit("device", name=cast.name)
+        return cast
+
+    def prewarm(self, cast):
+        """Connects to a device in the background so casting to it doesn't wait on the handshake."""
+        def task():
+            if self.connect(cast):
+                self.listen_media(cast)
+        threading.Thread(target=task, daemon=True).start()
+
+    def listen_media(self, cast):
+        with self.devices_lock:
+            if id(cast) in self.media_listeners:
+                return
+            self.media_listeners[id(cast)] = MediaEvents(self, cast)
+        cast.media_controller.register_status_listener(self.media_listeners[id(cast)])
+
+    def find_subtitles(self, video_path):
+        subs = {"None": None}
+        if not video_path or isinstance(video_path, dict):
+            return subs
+
+        internal_subs = self.get_internal_subtitles(video_path)
+        for idx, label in internal_subs:
+            subs[label] = f"internal:{idx}"
+
+        base_path = os.path.splitext(video_path)[0]
+        files = glob.glob(f"{glob.escape(base_path)}*.srt")
+        for f in files:
+            subs[os.path.basename(f)] = f
+        return subs
+
+    def default_subtitle(self, subs):
+        return next((v for k, v in subs.items() if k != "None"), None)
+
+    def get_internal_subtitles(self, video_path):
+        probe = PROBE_CACHE.get(video_path)
+        subs = []
+        for sub in (probe or {}).get("subtitles", []):
+            label = sub["language"] or sub["title"] or f"Stream {sub['index']}"
+            subs.append((sub["sub_index"], f"Internal: {label}"))
+        return subs
+
+    def get_duration(self, filename):
+        probe = PROBE_CACHE.get(filename)
+        return probe["duration"] if probe else 0
+
+    def queue_titles(self):
+        return [entry.label() for entry in self.queue]
+
+    def enqueue_files(self, filenames):
+        playlists = [f for f in filenames if f.lower().endswith(PLAYLIST_EXTENSIONS)]
+        filenames = [f for f in filenames if f not in playlists]
+        if filenames:
+            self.enqueue_entries([QueueEntry(path=f) for f in filenames], warm=len(filenames))
+        if playlists:
+            threading.Thread(target=self.enqueue_playlists, args=(playlists,), daemon=True).start()
+
+    def enqueue_entries(self, entries, warm=QUEUE_WARM_AHEAD):
+        self.queue.extend(entries)
+        self.emit("queue", added=len(entries))
+        local = [entry.path for entry in entries[:warm] if entry.path]
+        PROBE_CACHE.warm(local)
+        SUBTITLE_CACHE.warm(local)
+        THUMBNAIL_CACHE.warm(local)
+
+    def enqueue_playlists(self, playlists):
+        for playlist in playlists:
+            added = 0
+            try:
+                for batch in parse_m3u(playlist):
+                    self.enqueue_entries(batch, warm=0 if added else QUEUE_WARM_AHEAD)
+                    added += len(batch)
+                self.set_status(f"Added {added} item(s) from {os.path.basename(playlist)}.")
+            except OSError as e:
+                self.emit("error", text=f"Could not read playlist: {e}")
+
+    def enqueue_url(self, url):
+        def process_url():
+            self.set_status("Processing URL...")
+            try:
+                entries = URL_RESOLVER.expand(url)
+                if not entries:
+                    raise RuntimeError("No playable entries found")
+
+                self.queue.extend(entries)
+                self.emit("queue", added=len(entries))
+                for entry in entries[:2]:
+                    URL_RESOLVER.resolve_async(entry, self.format_target())
+                self.set_status(f"[URL] added {len(entries)} item(s) to queue.")
+            except Exception as e:
+                self.emit("error", text=f"Could not process URL: {e}")
+                self.set_status("URL processing failed.")
+
+        threading.Thread(target=process_url, daemon=True).start()
+
+    def clear_queue(self):
+        self.queue.clear()
+        self.emit("queue", added=0)
+
+    def use_hls(self, duration):
+        return FFmpegStreamHandler.stream_mode == "Segmented (HLS)" and duration > 0
+
+    def stream_request(self, local_ip, settings, duration, current_time=0, prewarm=False):
+        key = stream_key(settings)
+        # Stream URLs are deterministic per file and settings; a per-play serial keeps a repeated item's status events apart.
+        play = next(self.play_serial)
+        if settings.get('audio_only'):
+            return self.audio_request(local_ip, settings, key, current_time, play)
+        if self.use_hls(duration):
+            keep = (self.native_seek_key,) if prewarm and self.native_seek_key else ()
+            session = open_hls_session(settings, duration, keep=keep)
+            if prewarm:
+                threading.Thread(target=session.prewarm, daemon=True).start()
+            request = {
+                'url': f"http://{local_ip}:{self.port}/hls/{key}/index.m3u8?play={play}",
+                'content_type': HLS_MIME,
+                'media_info': {"hlsSegmentFormat": "fmp4", "hlsVideoSegmentFormat": "fmp4"},
+                'seek_time': 0,
+                'current_time': current_time,
+                'native_seek_key': key
+            }
+            return self.attach_sidecar(request, local_ip, settings)
+
+        cached_settings = self.cached_settings(settings)
+        if cached_settings:
+            token = register_stream(cached_settings, 0)
+            request = {
+                'url': f"http://{local_ip}:{self.port}/stream.mp4?id={token}&play={play}",
+                'content_type': VIDEO_MIME,
+                'media_info': None,
+                'seek_time': 0,
+                'current_time': current_time,
+                'native_seek_key': stream_key(cached_settings)
+            }
+            return self.attach_sidecar(request, local_ip, settings)
+
+        token = register_stream(settings, current_time)
+        if prewarm:
+            prestart_stream(token)
+        request = {
+            'url': f"http://{local_ip}:{self.port}/stream.mp4?id={token}&play={play}",
+            'content_type': VIDEO_MIME,
+            'media_info': None,
+            'seek_time': current_time,
+            'current_time': None,
+            'native_seek_key': None,
+            'token': token
+        }
+        return self.attach_sidecar(request, local_ip, settings)
+
+    def cached_settings(self, settings):
+        """Settings with a finished transcode on disk; a full-quality one (e.g. batch-prepared) also counts after a downshift."""
+        for candidate in (settings, dict(settings, rung=0)):
+            if TRANSCODE_CACHE.lookup(stream_key(candidate)):
+                return candidate
+        return None
+
+    def audio_request(self, local_ip, settings, key, current_time, play):
+        output = settings['audio_only']
+        direct = output['mode'] == "direct"
+        token = register_stream(settings, 0 if direct else current_time)
+        print(f"Audio-only stream ({output['mode']}, {output['mime']}): {os.path.basename(settings['video_file'])}")
+        return {
+            'url': f"http://{local_ip}:{self.port}/audio?id={token}&play={play}",
+            'content_type': output['mime'],
+            'media_info': None,
+            'seek_time': 0 if direct else current_time,
+            'current_time': current_time if direct else None,
+            'native_seek_key': key if direct else None,
+            'sidecar': None,
+            'subtitles': None
+        }
+
+    def attach_sidecar(self, request, local_ip, settings):
+        sub = settings.get('sidecar_subtitle')
+        request['sidecar'] = sub
+        request['subtitles'] = None
+        if sub:
+            track_id = SUBTITLE_CACHE.register(settings['video_file'], sub)
+            threading.Thread(target=SUBTITLE_CACHE.get, args=(track_id,), daemon=True).start()
+            offset = request['seek_time']
+            request['subtitles'] = f"http://{local_ip}:{self.port}/subs/{track_id}.vtt" + (f"?offset={offset}" if offset else "")
+        return request
+
+    def cast_request(self, request, title, metadata=None, enqueue=False):
+        kwargs = {'title': title, 'metadata': metadata}
+        if request['current_time']:
+            kwargs['current_time'] = request['current_time']
+        if request['media_info']:
+            kwargs['media_info'] = request['media_info']
+        if enqueue:
+            kwargs['enqueue'] = True
+        if request.get('subtitles'):
+            kwargs.update(subtitles=request['subtitles'], subtitles_mime="text/vtt", subtitle_id=1)
+        self.cast_device.media_controller.play_media(request['url'], content_type=request['content_type'], **kwargs)
+
+    def play_stream(self, local_ip, title, metadata=None, current_time=0):
+        previous = self.current_request
+        request = self.stream_request(local_ip, FFmpegStreamHandler.current_settings(), FFmpegStreamHandler.duration, current_time)
+        if previous and previous.get('token') and previous.get('token') != request.get('token'):
+            cancel_stream(previous['token'])
+        FFmpegStreamHandler.seek_time = request['seek_time']
+        self.native_seek_key = request['native_seek_key']
+        self.current_request = request
+        self.rate_controller.reset()
+        self.cast_request(request, title, metadata)
+
+    def seek(self, new_time):
+        if not (self.cast_device and self.is_playing):
+            return
+        self.hold_position(new_time)
+        with self.seek_lock:
+            self.pending_seek = new_time
+            if self.seek_timer:
+                self.seek_timer.cancel()
+            self.seek_timer = threading.Timer(SEEK_DEBOUNCE, self.flush_seek)
+            self.seek_timer.daemon = True
+            self.seek_timer.start()
+
+    def flush_seek(self):
+        with self.seek_lock:
+            new_time, self.pending_seek, self.seek_timer = self.pending_seek, None, None
+        if new_time is None or not self.is_playing:
+            return
+        try:
+            self.restart_stream(new_time)
+        except Exception as e:
+            print(f"Error seeking to {new_time}: {e}")
+
+    def refresh(self):
+        self.seek(self.current_position())
+
+    def hold_position(self, position):
+        """Pins the reported position to a seek target until the device reports a time near it."""
+        self.seek_target = position
+        self.seek_deadline = time.time() + SEEK_SETTLE_TIME
+        self.position_mark = (position, time.time(), False)
+        # Buffering after a seek is the seek itself, not a sign the stream can't keep up.
+        self.rate_controller.reset()
+
+    def track_status(self, status):
+        self.player_state = status.player_state
+        if status.current_time is None or status.player_state not in ("PLAYING", "PAUSED", "BUFFERING"):
+            return
+        position = FFmpegStreamHandler.seek_time + status.current_time
+        if self.seek_target is not None:
+            if abs(position - self.seek_target) > 5 and time.time() < self.seek_deadline:
+                return
+            self.seek_target = None
+        self.position_mark = (position, time.time(), status.player_state == "PLAYING")
+
+    def current_position(self):
+        position, marked, running = self.position_mark
+        if running:
+            position += time.time() - marked
+        if self.current_video_duration:
+            position = min(position, self.current_video_duration)
+        return position
+
+    def restart_stream(self, new_time):
+        with self.restart_lock:
+            settings = FFmpegStreamHandler.current_settings()
+            same_sidecar = (self.current_request or {}).get('sidecar') == settings['sidecar_subtitle']
+            if self.native_seek_key and self.native_seek_key == stream_key(settings) and same_sidecar:
+                self.hold_position(new_time)
+                self.cast_device.media_controller.seek(int(new_time))
+            else:
+                new_time = snap_to_keyframe(FFmpegStreamHandler.video_file, new_time, FFmpegStreamHandler.source_info)
+                self.hold_position(new_time)
+                local_ip = get_local_ip()
+                self.play_stream(local_ip, self.current_title, metadata=self.current_metadata, current_time=new_time)
+                self.start_lookahead(local_ip)
+
+    def set_stream_mode(self, mode):
+        FFmpegStreamHandler.stream_mode = mode
+        print(f"Streaming mode updated to: {FFmpegStreamHandler.stream_mode}")
+
+        if self.is_playing:
+            self.native_seek_key = None
+            self.refresh()
+
+    def set_subtitle_mode(self, mode):
+        FFmpegStreamHandler.subtitle_mode = mode
+        print(f"Subtitle mode updated to: {FFmpegStreamHandler.subtitle_mode}")
+        self.refresh()
+
+    def set_rate_mode(self, mode):
+        FFmpegStreamHandler.rate_mode = mode
+        print(f"Rate control updated to: {FFmpegStreamHandler.rate_mode}")
+        if FFmpegStreamHandler.rate_mode != "Adaptive" and FFmpegStreamHandler.rate_rung:
+            self.apply_rung(0)
+
+    def apply_rung(self, rung):
+        FFmpegStreamHandler.rate_rung = rung
+        settings = FFmpegStreamHandler.current_settings()
+        current = rate_rung(settings)
+        self.set_status(f"Quality: {current['resolution']} @ {current['bitrate']}k")
+        print(f"Rate control: switching to rung {rung} ({current})")
+        if self.is_playing and self.cast_device:
+            self.restart_stream(self.current_position())
+
+    def show_telemetry(self):
+        if time.time() - self.last_telemetry < TELEMETRY_INTERVAL:
+            return
+        self.last_telemetry = time.time()
+        stats = stream_stats(self.current_request)
+        if stats and stats.get("running"):
+            self.set_status(f"{FFmpegStreamHandler.encoder} | {format_stats(stats)}")
+
+    def check_rate(self, player_state):
+        if FFmpegStreamHandler.rate_mode != "Adaptive" or (self.current_request or {}).get('content_type', '').startswith("audio/"):
+            return
+        if player_state == "PAUSED" or self.seek_target is not None:
+            return
+        stats = stream_stats(self.current_request)
+        if not stats or not stats.get("running"):
+            # Cached files and finished encodes have no encoder to slow down; a shift would only reload the item.
+            return
+        rung = FFmpegStreamHandler.rate_rung
+        ladder = rate_ladder(FFmpegStreamHandler.resolution)
+        if self.current_request.get('token'):
+            stats["headroom"] = self.current_request['seek_time'] + stats["out_time"] - self.current_position()
+        new_rung = self.rate_controller.decide(stats, player_state, rung, len(ladder))
+        if new_rung != rung:
+            self.rate_controller.last_shift = time.time()
+            self.apply_rung(new_rung)
+
+    def skip_video(self):
+        if self.cast_device:
+            self.cast_device.media_controller.stop()
+
+    def set_volume(self, val):
+        if self.cast_device: self.cast_device.set_volume(float(val))
+
+    def stop_cast(self):
+        self.is_playing = False
+        with self.seek_lock:
+            if self.seek_timer:
+                self.seek_timer.cancel()
+            self.seek_timer = self.pending_seek = None
+        if self.cast_device: self.cast_device.media_controller.stop()
+        for session in list(HLS_SESSIONS.values()):
+            session.stop()
+        self.lookahead_generation += 1
+        self.next_prepared = None
+        self.current_request = None
+        self.events.put(("wake", None))
+        stop_shared_transcodes()
+
+        self.emit("stopped")
+        self.set_status("Stopped.")
+
+    def pause_cast(self):
+        if not self.cast_device or not self.is_playing:
+            return None
+        mc = self.cast_device.media_controller
+        if mc.status.player_state == "PLAYING":
+            mc.pause()
+            self.set_status("Paused")
+            return "paused"
+        mc.play()
+        self.set_status("Resuming...")
+        return "playing"
+
+    def pause(self):
+        if self.cast_device and self.is_playing and self.cast_device.media_controller.status.player_state == "PLAYING":
+            self.pause_cast()
+
+    def resume(self):
+        if self.cast_device and self.is_playing and self.cast_device.media_controller.status.player_state != "PLAYING":
+            self.pause_cast()
+
+    def start_playback(self, device=None):
+        if self.is_playing:
+            self.stop_cast()
+
+        if device is not None:
+            self.select_device(device)
+        if self.cast_device is None:
+            raise ValueError("No Chromecast selected")
+        if not self.queue:
+            raise ValueError("Queue is empty")
+
+        self.is_playing = True
+        self.playback_generation += 1
+        self.events = Queue()
+        threading.Thread(target=self.playback_loop, args=(self.playback_generation, self.events), daemon=True).start()
+        self.emit("playing", title=self.queue[0].label())
+
+    def batch_jobs(self, entries):
+        jobs, keys = [], set()
+        for entry in entries:
+            if self.batch.cancelled:
+                break
+            if entry.url:
+                continue
+            prepared = self.prepare_item(entry)
+            if not prepared['probe'] or not prepared['probe'].get('video'):
+                continue
+            settings = self.settings_for(prepared)
+            if settings.get('audio_only'):
+                continue
+            settings['rung'] = 0
+            # The same file listed twice (a folder and a playlist, say) would have two workers writing one part file.
+            key = stream_key(settings)
+            if key in keys:
+                continue
+            keys.add(key)
+            jobs.append({"title": prepared['title'], "settings": settings, "duration": prepared['duration']})
+        return jobs
+
+    def prepare_batch(self, sources=None):
+        """Encodes the queue (or the given files, folders and playlists) ahead of time with the current output settings."""
+        if self.batch_thread and self.batch_thread.is_alive():
+            raise ValueError("A batch prepare is already running")
+        self.batch = BatchPreparer([], batch_workers(FFmpegStreamHandler.encoder), report=self.set_status)
+
+        def task():
+            entries = list(batch_entries(sources)) if sources else list(self.queue)
+            self.set_status(f"Probing {len(entries)} item(s) to prepare...")
+            self.batch.jobs = self.batch_jobs(entries)
+            print(f"Batch prepare: {len(self.batch.jobs)} item(s) with {self.batch.workers} {FFmpegStreamHandler.encoder} worker(s)")
+            self.batch.run()
+
+        self.batch_thread = threading.Thread(target=task, daemon=True)
+        self.batch_thread.start()
+        return self.batch_thread
+
+    def cancel_batch(self):
+        if self.batch:
+            self.batch.cancel()
+
+    def state(self):
+        player_state = None
+        if self.cast_device and self.cast_device.media_controller.status:
+            player_state = self.cast_device.media_controller.status.player_state
+        return {
+            "playing": self.is_playing,
+            "player_state": player_state,
+            "title": self.current_title if self.is_playing else None,
+            "position": self.current_position(),
+            "duration": self.current_video_duration,
+            "queue": self.queue_titles(),
+            "device": self.cast_device.name if self.cast_device else None,
+            "devices": self.device_list(),
+            "encoder": FFmpegStreamHandler.encoder,
+            "resolution": FFmpegStreamHandler.resolution,
+            "stream_mode": FFmpegStreamHandler.stream_mode,
+            "status": self.status,
+            "stream": stream_stats(self.current_request),
+        }
+
+    def api(self, method, action, body):
+        """Dispatches /api/<action>; returns None for unknown actions and raises ValueError on bad input."""
+        if method == "GET":
+            if action == "status": return self.state()
+            if action == "devices": return {"devices": self.device_list()}
+            if action == "queue": return {"queue": self.queue_titles()}
+            if action == "processes": return {"max_encoders": SUPERVISOR.max_encoders, "processes": SUPERVISOR.snapshot()}
+            if action == "prepare": return self.batch.summary() if self.batch else {"running": False}
+            return None
+
+        if action == "queue":
+            if body.get("url"):
+                self.enqueue_url(body["url"])
+                return {"accepted": True}
+            paths = body.get("paths") or ([body["path"]] if body.get("path") else [])
+            if not paths:
+                raise ValueError("expected 'path', 'paths' or 'url'")
+            missing = [p for p in paths if not os.path.isfile(p)]
+            if missing:
+                raise ValueError(f"not a file: {missing[0]}")
+            self.enqueue_files(paths)
+        elif action == "queue/clear": self.clear_queue()
+        elif action == "prepare": self.prepare_batch(body.get("paths"))
+        elif action == "prepare/cancel": self.cancel_batch()
+        elif action == "play": self.start_playback(body.get("device"))
+        elif action == "pause": self.pause()
+        elif action == "resume": self.resume()
+        elif action == "seek": self.seek(float(body.get("position", self.current_position())))
+        elif action == "skip": self.skip_video()
+        elif action == "stop": self.stop_cast()
+        elif action == "device": self.select_device(body.get("device"))
+        elif action == "volume": self.set_volume(body.get("level", 1))
+        else:
+            return None
+        return self.state()
+
+    def prepare_item(self, item):
+        if item.url:
+            resolved = URL_RESOLVER.resolve_async(item, self.format_target()).result()
+            return {
+                'item': item,
+                'path': resolved['path'],
+                'audio_path': resolved['audio_path'],
+                'audio_headers': resolved['audio_headers'],
+                'title': item.title,
+                'duration': resolved['duration'] or item.duration or 0,
+                'headers': resolved['headers'],
+                'subs': {"None": None},
+                'probe': resolved['probe']
+            }
+        return {
+            'item': item,
+            'path': item.path,
+            'title': item.label(),
+            'duration': self.get_duration(item.path) or item.duration or 0,
+            'headers': {},
+            'subs': self.find_subtitles(item.path),
+            'probe': PROBE_CACHE.get(item.path)
+        }
+
+    def format_target(self):
+        fps = FFmpegStreamHandler.fps
+        return (
+            int(FFmpegStreamHandler.resolution.split('x')[1]),
+            0 if fps == "Original" else int(fps),
+            FFmpegStreamHandler.device_model
+        )
+
+    def settings_for(self, prepared):
+        settings = FFmpegStreamHandler.current_settings()
+        settings['video_file'] = prepared['path']
+        settings['audio_file'] = prepared.get('audio_path')
+        settings['headers_dict'] = dict(prepared['headers'])
+        settings['audio_headers'] = dict(prepared.get('audio_headers') or {})
+        settings['subtitle_file'] = self.default_subtitle(prepared['subs'])
+        return FFmpegStreamHandler.finish_settings(settings, prepared['probe'])
+
+    def item_image(self, prepared):
+        if prepared['item'].url:
+            return prepared['item'].thumbnail
+        thumb_id = THUMBNAIL_CACHE.ready(prepared['path'])
+        if thumb_id is None:
+            THUMBNAIL_CACHE.warm([prepared['path']])
+            return None
+        return f"http://{get_local_ip()}:{self.port}/thumb/{thumb_id}.jpg"
+
+    def item_metadata(self, prepared):
+        probe = prepared['probe'] or {}
+        if probe.get('video') is None and probe.get('audio'):
+            tags = probe.get('tags') or {}
+            metadata = {'metadataType': 3, 'title': tags.get('title') or prepared['title']}
+            if tags.get('artist'): metadata['artist'] = tags['artist']
+            if tags.get('album'): metadata['albumName'] = tags['album']
+        else:
+            metadata = {'metadataType': 1, 'title': prepared['title']}
+        image = self.item_image(prepared)
+        if image:
+            metadata['images'] = [{'url': image}]
+        return metadata
+
+    def start_lookahead(self, local_ip):
+        self.lookahead_generation += 1
+        generation = self.lookahead_generation
+        self.next_prepared = None
+        if not self.queue:
+            return
+        item = self.queue[0]
+
+        def task():
+            try:
+                prepared = self.prepare_item(item)
+                if generation != self.lookahead_generation or not self.is_playing or not self.queue or self.queue[0] is not item:
+                    return
+                settings = self.settings_for(prepared)
+                request = self.stream_request(local_ip, settings, prepared['duration'], prewarm=True)
+                prepared['request'] = request
+                self.cast_request(request, prepared['title'], self.item_metadata(prepared), enqueue=True)
+                self.next_prepared = prepared
+                print(f"Look-ahead ready: {prepared['title']}")
+            except Exception as e:
+                print(f"Error in look-ahead: {e}")
+        threading.Thread(target=task, daemon=True).start()
+
+    def activate_item(self, prepared):
+        FFmpegStreamHandler.headers_dict = prepared['headers']
+        FFmpegStreamHandler.video_file = prepared['path']
+        FFmpegStreamHandler.audio_file = prepared.get('audio_path')
+        FFmpegStreamHandler.audio_headers = prepared.get('audio_headers') or {}
+        FFmpegStreamHandler.seek_time = 0
+        FFmpegStreamHandler.duration = prepared['duration']
+        FFmpegStreamHandler.subtitle_file = self.default_subtitle(prepared['subs'])
+        FFmpegStreamHandler.source_info = prepared['probe']
+        print(f"Stream mode for {prepared['title']}: {FFmpegStreamHandler.current_settings()['passthrough']}")
+
+        if not prepared['item'].url and (prepared['probe'] or {}).get('video'):
+            KEYFRAME_CACHE.warm([prepared['path']])
+
+        self.current_title = prepared['title']
+        self.current_metadata = self.item_metadata(prepared)
+        self.current_video_duration = prepared['duration']
+        self.seek_target = None
+        self.position_mark = (0, time.time(), False)
+        self.emit("now_playing", title=prepared['title'], duration=prepared['duration'], subs=prepared['subs'])
+
+    def tick_interval(self):
+        """Only a running encode needs periodic rate and telemetry samples; otherwise wait for device events."""
+        stats = stream_stats(self.current_request)
+        if not stats or not stats.get("running"):
+            return None
+        return RATE_SAMPLE_INTERVAL if FFmpegStreamHandler.rate_mode == "Adaptive" else TELEMETRY_INTERVAL
+
+    def await_item_end(self, generation, events):
+        """Runs one item's state machine off media status events; returns the look-ahead item if the device advanced to it."""
+        while self.is_playing and generation == self.playback_generation:
+            try:
+                kind, payload = events.get(timeout=self.tick_interval())
+            except Empty:
+                self.check_rate(self.player_state)
+                self.show_telemetry()
+                continue
+            if kind == "wake":
+                continue
+            if kind == "failed":
+                print(f"Chromecast failed to load {self.current_title} (error {payload})")
+                return None
+
+            status = payload
+            upcoming = self.next_prepared
+            if upcoming is not None and status.content_id == upcoming['request']['url']:
+                if self.queue and self.queue[0] is upcoming['item']:
+                    return upcoming
+                self.cast_device.media_controller.stop()
+                return None
+            if status.content_id and status.content_id != (self.current_request or {}).get('url'):
+                continue
+            if status.player_state == "IDLE" and status.idle_reason in ("FINISHED", "CANCELLED", "ERROR"):
+                return None
+            self.track_status(status)
+            if status.player_state == "BUFFERING":
+                self.check_rate(status.player_state)
+        return None
+
+    def playback_loop(self, generation, events):
+        try:
+            cast = self.cast_device
+            if not self.connect(cast):
+                if generation == self.playback_generation:
+                    self.is_playing = False
+                    self.emit("stopped")
+                    self.set_status(f"Could not connect to {cast.name}.")
+                return
+            self.listen_media(cast)
+            local_ip = get_local_ip()
+            advanced = None
+            while self.is_playing and generation == self.playback_generation and self.queue:
+                item = self.queue.popleft()
+                self.emit("dequeued")
+
+                if advanced is not None:
+                    prepared = advanced
+                elif self.next_prepared is not None and self.next_prepared['item'] is item:
+                    prepared = self.next_prepared
+                else:
+                    try:
+                        prepared = self.prepare_item(item)
+                    except Exception as e:
+                        print(f"Could not prepare {item}: {e}")
+                        self.set_status("Skipped an item that failed to resolve.")
+                        continue
+                self.next_prepared = None
+
+                self.activate_item(prepared)
+                self.start_server()
+
+                if advanced is not None:
+                    FFmpegStreamHandler.seek_time = advanced['request']['seek_time']
+                    self.native_seek_key = advanced['request']['native_seek_key']
+                    self.current_request = advanced['request']
+                    self.rate_controller.reset()
+                else:
+                    self.play_stream(local_ip, prepared['title'], metadata=self.current_metadata)
+                self.start_lookahead(local_ip)
+                advanced = self.await_item_end(generation, events)
+
+            if generation == self.playback_generation and self.is_playing and not self.queue:
+                self.stop_cast()
+        except Exception as e:
+            print(f"Error in playback loop: {e}")
+
+class QueueView:
+    """Queue list that only renders the rows in view, so huge playlists don't stall Tk."""
+    def __init__(self, parent, play_queue, **options):
+        self.play_queue = play_queue
+        self.offset = 0
+        self.rows = options.get("height", 4)
+        self.frame = ttk.Frame(parent)
+        self.listbox = tk.Listbox(self.frame, **options)
+        self.scrollbar = ttk.Scrollbar(self.frame, orient=tk.VERTICAL, command=self.on_scroll)
+        self.listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.row_height = tkfont.Font(font=self.listbox.cget("font")).metrics("linespace") + 1
+        self.listbox.bind("<Configure>", self.on_resize)
+        for sequence in ("<MouseWheel>", "<Button-4>", "<Button-5>"):
+            self.listbox.bind(sequence, self.on_wheel)
+
+    def pack(self, **options):
+        self.frame.pack(**options)
+
+    def refresh(self):
+        total = len(self.play_queue)
+        self.offset = max(0, min(self.offset, total - self.rows))
+        titles = [entry.label() for entry in self.play_queue.window(self.offset, self.rows)]
+        self.listbox.delete(0, tk.END)
+        if titles:
+            self.listbox.insert(tk.END, *titles)
+        if total:
+            self.scrollbar.set(self.offset / total, (self.offset + len(titles)) / total)
+        else:
+            self.scrollbar.set(0, 1)
+
+    def on_resize(self, event):
+        rows = max(1, event.height // self.row_height)
+        if rows != self.rows:
+            self.rows = rows
+            self.refresh()
+
+    def on_scroll(self, action, *args):
+        if action == "moveto":
+            self.offset = int(float(args[0]) * len(self.play_queue))
+        elif action == "scroll":
+            self.offset += int(args[0]) * (self.rows if args[1] == "pages" else 1)
+        self.refresh()
+
+    def on_wheel(self, event):
+        if event.num == 4 or event.delta > 0:
+            self.offset -= 3
+        else:
+            self.offset += 3
+        self.refresh()
+        return "break"
 
 class ChromecastGui:
-    def __init__(self, root):
+    def __init__(self, root, engine):
         self.root = root
         self.root.title(f"sakuraCast")
         self.root.geometry("600x720")
         self.root.configure(bg=BG_COLOR)
-        
-        self.server = None
-        self.cast_device = None
-        self.browser = None
-        self.chromecasts = []
-        self.queue = deque()
-        self.is_playing = False
-        self.current_video_duration = 0
-        self.manual_seek_cooldown = 0
-        self.seek_lock_time = 0 
+
+        self.engine = engine
         self.seeking = False
-        
+        self.pending_events = []
+        self.events_lock = threading.Lock()
+        self.ticking = False
+
         self.apply_styles()
         self.setup_ui()
-        self.check_for_update()
-        self.discover_chromecasts()
-        self.detect_hardware_acceleration()
+        STARTUP_PROFILE.mark("ui built")
         self.detected_subs = {"None": None}
         self.selected_subtitles = None
+        self.engine.listeners.append(self.on_engine_event)
+        self.root.after_idle(self.start_background_tasks)
+
+    def start_background_tasks(self):
+        self.root.update_idletasks()
+        STARTUP_PROFILE.mark("window rendered")
+        self.engine.start()
+        threading.Thread(target=self.check_for_update, daemon=True).start()
+
+    def on_engine_event(self, event, data):
+        with self.events_lock:
+            self.pending_events.append((event, data))
+            if len(self.pending_events) > 1:
+                return
+        self.root.after(UI_FLUSH_INTERVAL, self.flush_engine_events)
+
+    def flush_engine_events(self):
+        """Applies queued engine events in one batch, skipping status lines and queue redraws that a later one replaces."""
+        with self.events_lock:
+            events, self.pending_events = self.pending_events, []
+        latest = {("queue" if event == "dequeued" else event): i for i, (event, _) in enumerate(events)}
+        for i, (event, data) in enumerate(events):
+            if event not in ("status", "queue", "dequeued") or latest[("queue" if event == "dequeued" else event)] == i:
+                self.handle_engine_event(event, data)
+
+    def tick_position(self):
+        if not self.engine.is_playing:
+            self.ticking = False
+            return
+        if not self.seeking:
+            position = self.engine.current_position()
+            self.seek_var.set(position)
+            self.time_elapsed_var.set(format_time(position))
+        self.root.after(POSITION_TICK, self.tick_position)
+
+    def handle_engine_event(self, event, data):
+        if event == "status":
+            self.status_var.set(data["text"])
+        elif event == "error":
+            messagebox.showerror("Error", data["text"])
+        elif event == "queue":
+            self.queue_view.refresh()
+        elif event == "dequeued":
+            self.queue_view.refresh()
+        elif event == "devices":
+            self.show_chromecasts(data["devices"])
+        elif event == "playing":
+            self.btn_cast.config(state=tk.DISABLED)
+            self.btn_stop.config(state=tk.NORMAL)
+            self.btn_pause.config(state=tk.NORMAL)
+            self.root.title(f"sakuraCast - {data['title']}")
+            if not self.ticking:
+                self.ticking = True
+                self.tick_position()
+        elif event == "now_playing":
+            self.detected_subs = data["subs"]
+            self.update_sub_combo()
+            self.title_var.set(f"Now Playing: {data['title']}")
+            self.root.title(f"sakuraCast - {data['title']}")
+            self.seek_slider.config(to=int(data["duration"]) if data["duration"] > 0 else 100)
+            self.time_total_var.set(format_time(data["duration"]))
+            self.seek_var.set(0)
+        elif event == "stopped":
+            self.title_var.set("No file playing")
+            self.root.title("sakuraCast")
+            self.btn_cast.config(state=tk.NORMAL)
+            self.btn_pause.config(state=tk.DISABLED, text="Pause")
+            self.btn_stop.config(state=tk.DISABLED)
 
     def check_for_update(self):
         version_url = "https://raw.githubusercontent.com/faithvoid/sakuraCast/refs/heads/main/version.txt"
         try:
-            response = requests.get(version_url)
+            import requests
+            response = requests.get(version_url, timeout=5)
             if response.status_code == 200:
                 remote_version = response.text.strip()
                 if remote_version != VERSION:
-                    self.display_update_available()
+                    self.root.after(0, self.display_update_available)
                     print(f"Remote version: {remote_version}")
 
         except Exception as e:
             print(f"Error checking for update: {e}")
+        STARTUP_PROFILE.mark("update check done")
 
     def display_update_available(self):
         update_label = ttk.Label(self.update_container, text="Update Available!", foreground=ACCENT_COLOR, font=('Helvetica', 10, 'bold'),cursor="hand2")
         update_label.pack(pady=(0, 0))
 
-
-    def generate_thumbnail(self, video_path):
-        thumb_path = os.path.join(SCRIPT_DIR, "thumb.jpg")
-        cmd = ["ffmpeg", "-y", "-i", video_path, "-ss", "00:00:05", "-vframes", "1", "-q:v", "2", thumb_path]
-        try:
-            subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        except: pass
-
-    def detect_hardware_acceleration(self):
-        system = platform.system()
-        found_hw = False
-
-        if system == "Windows":
-            for enc in ["h264_nvenc", "h264_qsv", "h264_amf"]:
-                if self.test_ffmpeg_encoder(enc):
-                    FFmpegStreamHandler.encoder = enc
-                    found_hw = True
-                    break
-        
-        elif system == "Darwin":
-            if self.test_ffmpeg_encoder("h264_videotoolbox"):
-                FFmpegStreamHandler.encoder = "h264_videotoolbox"
-                found_hw = True
-
-        elif system in ["Linux", "FreeBSD"]:
-            va_args = ["-vaapi_device", "/dev/dri/renderD128", "-vf", "format=nv12,hwupload"]
-            if os.path.exists("/dev/dri/renderD128"):
-                if self.test_ffmpeg_encoder("h264_vaapi", va_args):
-                    FFmpegStreamHandler.encoder = "h264_vaapi"
-                    FFmpegStreamHandler.hw_args = ["-vaapi_device", "/dev/dri/renderD128"]
-                    found_hw = True
-            
-            if not found_hw and self.test_ffmpeg_encoder("h264_nvenc"):
-                FFmpegStreamHandler.encoder = "h264_nvenc"
-                found_hw = True
-
-        if not found_hw:
-            FFmpegStreamHandler.encoder = "libx264"
-            FFmpegStreamHandler.hw_args = []
-        
-        self.status_var.set(f"Encoder: {FFmpegStreamHandler.encoder}")
-        print(f"OS: {system} | Selected: {FFmpegStreamHandler.encoder}")
-
     def update_overscan(self, event=None):
         try:
             FFmpegStreamHandler.crop_top = int(self.crop_vars['top'].get())
             FFmpegStreamHandler.crop_bottom = int(self.crop_vars['bottom'].get())
             FFmpegStreamHandler.crop_left = int(self.crop_vars['left'].get())
             FFmpegStreamHandler.crop_right = int(self.crop_vars['right'].get())
-            
-            if self.is_playing:
-                self.on_seek_release(None)
+
+            self.engine.refresh()
         except ValueError:
             pass
 
-    def test_ffmpeg_encoder(self, encoder_name, extra_args=[]):
-        test_cmd = [
-            "ffmpeg", "-y", 
-            "-f", "lavfi", "-i", "color=c=black:s=640x480", 
-            "-frames:v", "1"
-        ] + extra_args + ["-c:v", encoder_name, "-f", "null", "-"]
-        
-        try:
-            res = subprocess.run(test_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-            return res.returncode == 0
-        except: 
-            return False
-
     def scan_for_subtitles(self, video_path):
-        self.detected_subs = {"None": None}
-        if not video_path or isinstance(video_path, dict):
-            self.update_sub_combo()
-            return
-
-        internal_subs = self.get_internal_subtitles(video_path)
-        for idx, label in internal_subs:
-            self.detected_subs[label] = f"internal:{idx}"
-
-        base_path = os.path.splitext(video_path)[0]
-        files = glob.glob(f"{glob.escape(base_path)}*.srt")
-        for f in files:
-            self.detected_subs[os.path.basename(f)] = f
-        
+        self.detected_subs = self.engine.find_subtitles(video_path)
         self.update_sub_combo()
 
-    def get_internal_subtitles(self, video_path):
-        cmd = [
-            "ffprobe", "-v", "error", "-select_streams", "s", 
-            "-show_entries", "stream=index:stream_tags=language,title", 
-            "-of", "csv=p=0", video_path
-        ]
-        subs = []
-        try:
-            result = subprocess.run(cmd, stdout=subprocess.PIPE, text=True, timeout=5)
-            if result.stdout:
-                for line in result.stdout.strip().split('\n'):
-                    parts = line.split(',')
-                    index = parts[0]
-                    label = next((p for p in parts[1:] if p), f"Stream {index}")
-                    subs.append((index, f"Internal: {label}"))
-        except: pass
-        return subs
-
     def update_sub_combo(self):
         self.sub_combo['values'] = list(self.detected_subs.keys())
         if len(self.detected_subs) > 1:
@@ -342,8 +3618,7 @@ class ChromecastGui:
     def on_subtitle_selected(self, event=None):
         selected = self.sub_selection_var.get()
         FFmpegStreamHandler.subtitle_file = self.detected_subs.get(selected)
-        if self.is_playing:
-            self.on_seek_release(None)
+        self.engine.refresh()
 
     def load_subtitles(self):
         file = filedialog.askopenfilename(filetypes=[("Subtitle files", "*.srt *.ass")])
@@ -353,8 +3628,7 @@ class ChromecastGui:
             self.update_sub_combo()
             self.sub_selection_var.set(label)
             FFmpegStreamHandler.subtitle_file = file
-            if self.is_playing:
-                self.on_seek_release(None)
+            self.engine.refresh()
 
     def apply_styles(self):
         style = ttk.Style()
@@ -395,8 +3669,9 @@ class ChromecastGui:
         ttk.Label(version_frame, text=f"v{VERSION}", foreground="#F8C8DC").pack(side="left")
 
         ttk.Label(main_frame, text="Queue", font=('Helvetica', 9, 'bold'), foreground=ACCENT_COLOR).pack(anchor=tk.CENTER)
-        self.queue_listbox = tk.Listbox(main_frame, bg=SECONDARY_BG, fg=FG_COLOR, selectbackground=ACCENT_COLOR, selectforeground=BG_COLOR, borderwidth=0, height=4)
-        self.queue_listbox.pack(fill=tk.BOTH, expand=True, pady=2)
+        self.queue_view = QueueView(main_frame, self.engine.queue, bg=SECONDARY_BG, fg=FG_COLOR, selectbackground=ACCENT_COLOR, selectforeground=BG_COLOR, borderwidth=0, height=4)
+        self.queue_view.pack(fill=tk.BOTH, expand=True, pady=2)
+        self.queue_view.refresh()
 
         url_frame = ttk.LabelFrame(main_frame, text="Video URL", labelanchor='n')
         url_frame.pack(fill=tk.X, pady=2)
@@ -414,6 +3689,7 @@ class ChromecastGui:
         btn_frame.pack(fill=tk.X)
         ttk.Button(btn_frame, text="Add File(s)", command=self.add_to_queue).pack(side=tk.LEFT, expand=True, fill=tk.X, padx=2)
         ttk.Button(btn_frame, text="Clear Queue", command=self.clear_queue).pack(side=tk.LEFT, expand=True, fill=tk.X, padx=2)
+        ttk.Button(btn_frame, text="Prepare Queue", command=self.prepare_queue).pack(side=tk.LEFT, expand=True, fill=tk.X, padx=2)
 
         sub_frame = ttk.LabelFrame(main_frame, text="Subtitles", labelanchor='n')
         sub_frame.pack(fill=tk.X, pady=5)
@@ -423,11 +3699,17 @@ class ChromecastGui:
         self.sub_combo = ttk.Combobox(sub_frame, textvariable=self.sub_selection_var, state="readonly")
         self.sub_combo.pack(side=tk.LEFT, expand=True, fill=tk.X, padx=5, pady=2)
         self.sub_combo.bind("<<ComboboxSelected>>", self.on_subtitle_selected)
+        self.sub_mode_options = ["Sidecar", "Burn-in"]
+        self.sub_mode_var = tk.StringVar(value=self.sub_mode_options[0])
+        self.sub_mode_combo = ttk.Combobox(sub_frame, textvariable=self.sub_mode_var, values=self.sub_mode_options, state="readonly", width=8)
+        self.sub_mode_combo.pack(side=tk.LEFT, padx=5, pady=2)
+        self.sub_mode_combo.bind("<<ComboboxSelected>>", self.update_subtitle_mode)
         ttk.Button(sub_frame, text="Browse...", command=self.load_subtitles).pack(side=tk.RIGHT, padx=5)
 
         ttk.Label(main_frame, text="Chromecast", font=('Helvetica', 9, 'bold'), foreground=ACCENT_COLOR).pack(anchor=tk.N)
         self.device_list = tk.Listbox(main_frame, bg=SECONDARY_BG, fg=FG_COLOR, borderwidth=0, height=3)
         self.device_list.pack(fill=tk.X, pady=2)
+        self.device_list.bind("<<ListboxSelect>>", self.on_device_select)
 
         settings_row = ttk.Frame(main_frame)
         settings_row.pack(fill=tk.X, pady=2)
@@ -450,6 +3732,24 @@ class ChromecastGui:
         self.fps_combo.pack(fill=tk.X, pady=1)
         self.fps_combo.bind("<<ComboboxSelected>>", self.update_fps)
 
+        mode_frame = ttk.Frame(settings_row)
+        mode_frame.pack(side=tk.LEFT, expand=True, fill=tk.X, padx=(5, 0))
+        ttk.Label(mode_frame, text="Streaming", font=('Helvetica', 9, 'bold'), foreground=ACCENT_COLOR).pack(anchor=tk.N)
+        self.mode_options = ["Progressive", "Segmented (HLS)"]
+        self.mode_display_var = tk.StringVar(value=self.mode_options[0])
+        self.mode_combo = ttk.Combobox(mode_frame, textvariable=self.mode_display_var, values=self.mode_options, state="readonly", width=14)
+        self.mode_combo.pack(fill=tk.X, pady=1)
+        self.mode_combo.bind("<<ComboboxSelected>>", self.update_mode)
+
+        rate_frame = ttk.Frame(settings_row)
+        rate_frame.pack(side=tk.LEFT, expand=True, fill=tk.X, padx=(5, 0))
+        ttk.Label(rate_frame, text="Bitrate", font=('Helvetica', 9, 'bold'), foreground=ACCENT_COLOR).pack(anchor=tk.N)
+        self.rate_options = ["Adaptive", "Fixed"]
+        self.rate_display_var = tk.StringVar(value=self.rate_options[0])
+        self.rate_combo = ttk.Combobox(rate_frame, textvariable=self.rate_display_var, values=self.rate_options, state="readonly", width=10)
+        self.rate_combo.pack(fill=tk.X, pady=1)
+        self.rate_combo.bind("<<ComboboxSelected>>", self.update_rate_mode)
+
         ttk.Label(main_frame, text="Aspect Ratio", font=('Helvetica', 9, 'bold'), foreground=ACCENT_COLOR).pack(anchor=tk.N)
         self.ar_options = {"Widescreen (16:9)": "16/9", "Fullscreen (4:3)": "4/3", "Vertical (9:16)": "9/16"}
         self.ar_display_var = tk.StringVar(value="Widescreen (16:9)")
@@ -510,7 +3810,9 @@ class ChromecastGui:
         self.vol_scale.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=2)
 
         self.status_var = tk.StringVar(value="Searching...")
-        ttk.Label(main_frame, textvariable=self.status_var, foreground="#F8C8DC", font=('Helvetica', 8)).pack()
+        status_label = ttk.Label(main_frame, textvariable=self.status_var, foreground="#F8C8DC", font=('Helvetica', 8), cursor="hand2")
+        status_label.pack()
+        status_label.bind("<Button-1>", lambda e: self.engine.detect_hardware_acceleration(force=True))
         
         line_frame = ttk.Frame(main_frame)
         line_frame.pack()
@@ -526,8 +3828,7 @@ class ChromecastGui:
         
         FFmpegStreamHandler.aspect_ratio = internal_val
         
-        if self.is_playing:
-            self.on_seek_release(None)
+        self.engine.refresh()
 
     def update_res(self, event=None):
         FFmpegStreamHandler.resolution = self.res_display_var.get()
@@ -537,15 +3838,16 @@ class ChromecastGui:
         FFmpegStreamHandler.fps = self.fps_display_var.get()
         print(f"FPS updated to: {FFmpegStreamHandler.fps}")
 
-        if self.is_playing:
-            self.on_seek_release(None)
+        self.engine.refresh()
 
-    def get_duration(self, filename):
-        cmd = ["ffprobe", "-v", "error", "-select_streams", "v:0", "-show_entries", "format=duration", "-of", "default=noprint_wrappers=1:nokey=1", filename]
-        try:
-            result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, timeout=5)
-            return float(result.stdout.strip())
-        except: return 0
+    def update_mode(self, event=None):
+        self.engine.set_stream_mode(self.mode_display_var.get())
+
+    def update_subtitle_mode(self, event=None):
+        self.engine.set_subtitle_mode(self.sub_mode_var.get())
+
+    def update_rate_mode(self, event=None):
+        self.engine.set_rate_mode(self.rate_display_var.get())
 
     def add_to_queue(self):
         file_types = [
@@ -555,208 +3857,110 @@ class ChromecastGui:
             ("All files", "*.*")
         ]
         filenames = filedialog.askopenfilenames(filetypes=file_types)
-        for f in filenames:
-            self.queue.append(f)
-            self.queue_listbox.insert(tk.END, os.path.basename(f))
+        if filenames:
+            self.engine.enqueue_files(list(filenames))
 
     def add_url_to_queue(self):
         url = self.url_var.get().strip()
         if not url: return
-        
-        def process_url():
-            self.status_var.set("Processing URL...")
-            try:
-                ydl_opts = {
-                    'format': 'bestvideo+bestaudio/best/b',
-                    'ignoreerrors': True,
-                    'nocheckcertificate': True,
-                    'quiet': False,
-                    'no_warnings': False,
-                    'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-                    'extractor_args': {
-                        'youtube': {'player_client': ['android', 'web']},
-                        'nicovideo': {'player_client': ['watch_os', 'pc']}
-                    }
-                }
-
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    info = ydl.extract_info(url, download=False)
-
-                    if 'formats' in info:
-                        best_format = max(info['formats'], key=lambda f: f.get('height', 0) or 0)
-                        video_url = best_format['url']
-                    else:
-                        video_url = info['url']
-
-                    self.queue.append({
-                        'path': video_url,
-                        'title': info.get('title', 'Web Video'),
-                        'duration': info.get('duration', 0)
-                    })
-
-                    self.root.after(0, lambda t=info.get('title', 'Web Video'): self.queue_listbox.insert(tk.END, f"[URL] {t}"))
-                    self.url_var.set("")
-                    self.status_var.set(f"[URL] added to queue.")
-            except Exception as e:
-                messagebox.showerror("Error", f"Could not process URL: {e}")
-                self.status_var.set("URL processing failed.")
-
-        threading.Thread(target=process_url, daemon=True).start()
+        self.url_var.set("")
+        self.engine.enqueue_url(url)
 
     def clear_queue(self):
-        self.queue.clear()
-        self.queue_listbox.delete(0, tk.END)
+        self.engine.clear_queue()
 
-    def discover_chromecasts(self):
-        def task():
-            self.chromecasts, self.browser = pychromecast.get_chromecasts()
-            self.device_list.delete(0, tk.END)
-            for cc in self.chromecasts:
-                model_type = getattr(cc.cast_info, 'model_name', getattr(cc, 'model_name', 'Unknown'))
-                display_name = f"{cc.name} ({model_type})"
-                self.device_list.insert(tk.END, display_name)
-                
-            self.status_var.set(f"Found {len(self.chromecasts)} Chromecast(s).")
+    def prepare_queue(self):
+        try:
+            self.engine.prepare_batch()
+        except ValueError as e:
+            self.status_var.set(str(e))
+
+    def show_chromecasts(self, devices):
+        selection = self.device_list.curselection()
+        selected = self.device_list.get(selection[0]) if selection else None
+        self.device_list.delete(0, tk.END)
+        for device in devices:
+            label = f"{device['name']} ({device['model']})"
+            self.device_list.insert(tk.END, label)
+            if label == selected:
+                self.device_list.selection_set(tk.END)
+        if not self.engine.is_playing:
             self.btn_cast.config(state=tk.NORMAL)
-        threading.Thread(target=task, daemon=True).start()
+
+    def on_device_select(self, event=None):
+        selection = self.device_list.curselection()
+        if selection:
+            try:
+                self.engine.prewarm(self.engine.find_device(selection[0]))
+            except ValueError:
+                pass
+
     def on_seek_start(self, event):
         self.seeking = True
 
     def on_seek_release(self, event):
-        if self.cast_device and self.is_playing:
-            new_time = self.seek_var.get()
-            FFmpegStreamHandler.seek_time = int(new_time)
-            self.manual_seek_cooldown = time.time() + 5
-            self.seek_lock_time = time.time() + 8
-            local_ip = get_local_ip()
-            stream_url = f"http://{local_ip}:8000/stream.mp4?t={time.time()}"
-            display_title = os.path.basename(FFmpegStreamHandler.video_file)
-            self.cast_device.media_controller.play_media(stream_url, content_type=VIDEO_MIME, title=display_title)
+        self.engine.seek(self.seek_var.get())
         self.seeking = False
 
     def skip_video(self):
-        if self.cast_device:
-            self.seek_lock_time = 0 
-            self.cast_device.media_controller.stop()
+        self.engine.skip_video()
 
     def set_volume(self, val):
-        if self.cast_device: self.cast_device.set_volume(float(val))
+        self.engine.set_volume(val)
 
     def stop_cast(self):
-        self.is_playing = False
-        self.title_var.set("No file playing")
-        if self.cast_device: self.cast_device.media_controller.stop()
-        if self.server: self.server.shutdown()
-
-        self.root.title("sakuraCast")
-        self.status_var.set("Stopped.")
-        
-        self.btn_cast.config(state=tk.NORMAL)
-        self.btn_pause.config(state=tk.DISABLED, text="Pause")
-        self.btn_stop.config(state=tk.DISABLED)
+        self.engine.stop_cast()
 
     def pause_cast(self):
-        if not self.cast_device or not self.is_playing:
-            return
-        
-        mc = self.cast_device.media_controller
-        if mc.status.player_state == "PLAYING":
-            mc.pause()
-            self.status_var.set("Paused")
-            self.btn_pause.config(text="Resume")
-        else:
-            mc.play()
-            self.status_var.set("Resuming...")
-            self.btn_pause.config(text="Pause")
+        state = self.engine.pause_cast()
+        if state:
+            self.btn_pause.config(text="Resume" if state == "paused" else "Pause")
 
     def start_playback(self):
-        if self.is_playing:
-            self.stop_cast()
-            time.sleep(0.5)
-        
         selection = self.device_list.curselection()
-        if not selection or not self.queue: return
-    
-        self.cast_device = self.chromecasts[selection[0]]
-        self.is_playing = True
-        self.btn_cast.config(state=tk.DISABLED)
-        self.btn_stop.config(state=tk.NORMAL)
-        self.btn_pause.config(state=tk.NORMAL)
-        threading.Thread(target=self.playback_loop, daemon=True).start()
-
-        display_name = self.queue[0]['title'] if isinstance(self.queue[0], dict) else os.path.basename(self.queue[0])
-        self.root.title(f"sakuraCast - {display_name}")
-
-    def playback_loop(self):
+        if not selection or not self.engine.queue: return
         try:
-            self.cast_device.wait()
-            local_ip = get_local_ip()
-            while self.is_playing and self.queue:
-                item = self.queue.popleft()
-                self.queue_listbox.delete(0)
-
-                FFmpegStreamHandler.subtitle_file = None
-                FFmpegStreamHandler.seek_time = 0
-                self.root.after(0, lambda: self.sub_selection_var.set("None"))
-
-                if isinstance(item, dict):
-                    video_path = item['path']
-                    display_name = item['title']
-                    duration = item.get('duration', 0)
-                    FFmpegStreamHandler.headers_dict = item.get('headers', {}) 
-                else:
-                    video_path = item
-                    display_name = os.path.basename(item)
-                    self.root.after(0, lambda p=video_path: self.scan_for_subtitles(p))
-                    duration = self.get_duration(item)
-                    FFmpegStreamHandler.headers_dict = {}
-
-                if not isinstance(item, dict):
-                    self.generate_thumbnail(video_path)
-                
-                self.title_var.set(f"Now Playing: {display_name}")
-                self.current_video_duration = duration
-                
-                self.root.after(0, lambda d=self.current_video_duration: self.seek_slider.config(to=int(d) if d > 0 else 100))
-                self.root.after(0, lambda d=self.current_video_duration: self.time_total_var.set(format_time(d)))
-
-                FFmpegStreamHandler.video_file = video_path
-                FFmpegStreamHandler.seek_time = 0
-                self.seek_var.set(0)
-
-                if not self.server:
-                    self.server = socketserver.ThreadingTCPServer(("0.0.0.0", 8000), FFmpegStreamHandler)
-                    threading.Thread(target=self.server.serve_forever, daemon=True).start()
-
-                mc = self.cast_device.media_controller
-                mc.play_media(
-                    f"http://{local_ip}:8000/stream.mp4", 
-                    content_type=VIDEO_MIME, 
-                    title=display_name, 
-                    metadata={
-                        'metadataType': 1, 
-                        'title': display_name, 
-#                        'images': [{'url': f"http://{local_ip}:8000/thumb.jpg"}]
-                    }
-                )
-
-                time.sleep(3) 
-                while self.is_playing:
-                    if mc.status.player_state == "IDLE" and time.time() > self.seek_lock_time: 
-                        break
-                    if not self.seeking and time.time() > self.manual_seek_cooldown:
-                        cc_time = mc.status.current_time if mc.status.current_time else 0
-                        current_pos = FFmpegStreamHandler.seek_time + cc_time
-                        self.root.after(0, lambda p=current_pos: self.seek_var.set(p))
-                        self.root.after(0, lambda p=current_pos: self.time_elapsed_var.set(format_time(p)))
-                    time.sleep(1)
-
-            if not self.queue: 
-                self.stop_cast()
-        except Exception as e: 
-            print(f"Error in playback loop: {e}")
+            self.engine.start_playback(selection[0])
+        except ValueError as e:
+            self.status_var.set(str(e))
 
 if __name__ == "__main__":
-    root = tk.Tk()
-    app = ChromecastGui(root)
-    root.mainloop()
+    import argparse
+    parser = argparse.ArgumentParser(description="Cast local and online media to Chromecast devices.")
+    parser.add_argument("--startup-profile", action="store_true", help="print per-phase startup timings")
+    parser.add_argument("--daemon", action="store_true", help="run without the GUI and take commands over the HTTP control API")
+    parser.add_argument("--device", help="Chromecast name (or index) to select once discovered")
+    parser.add_argument("--prepare", nargs="*", metavar="PATH", help="encode the saved queue (or these files, folders and playlists) ahead of time, then exit")
+    args = parser.parse_args()
+    STARTUP_PROFILE.enabled = args.startup_profile
+    STARTUP_PROFILE.mark("module loaded")
+
+    engine = CastEngine()
+    engine.preferred_device = args.device
+
+    if args.prepare is not None:
+        engine.listeners.append(lambda event, data: print(data['text']) if event in ("status", "error") else None)
+        engine.detect_hardware_acceleration(wait=True)
+        batch_thread = engine.prepare_batch(args.prepare)
+        try:
+            while batch_thread.is_alive():
+                batch_thread.join(1)
+        except KeyboardInterrupt:
+            engine.cancel_batch()
+            batch_thread.join()
+    elif args.daemon:
+        engine.listeners.append(lambda event, data: print(f"[{event}] {data['text']}") if event in ("status", "error") else None)
+        engine.start()
+        print(f"sakuraCast daemon: control API at http://{get_local_ip()}:{engine.port}/api/status")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            engine.stop_cast()
+    else:
+        if tk is None:
+            raise SystemExit("tkinter is not available; run with --daemon for headless mode.")
+        root = tk.Tk()
+        STARTUP_PROFILE.mark("tk root created")
+        app = ChromecastGui(root, engine)
+        root.mainloop()
@@ -0,0 +1,114 @@
+import pytest
+
+import sakuraCast as sc
+
+
+def settings(**overrides):
+    base = {
+        "video_file": "/media/show.mkv", "subtitle_file": None, "encoder": "libx264",
+        "aspect_ratio": "16/9", "resolution": "1920x1080", "fps": "Original", "rung": 0,
+        "crop_top": 0, "crop_bottom": 0, "crop_left": 0, "crop_right": 0,
+    }
+    base.update(overrides)
+    return base
+
+
+def video(width=1920, height=1080, fps=24.0, pix_fmt="yuv420p", rotation=0):
+    return {"video": {"width": width, "height": height, "fps": fps, "pix_fmt": pix_fmt, "rotation": rotation}}
+
+
+@pytest.fixture(autouse=True)
+def no_extracted_subtitles(monkeypatch):
+    monkeypatch.setattr(sc.SUBTITLE_CACHE, "extracted", lambda video_file, sub_index: None)
+
+
+def test_identity_source_elides_every_stage():
+    assert sc.plan_video_filter(settings(), 0, video()) == ["setdar=16/9"]
+
+
+def test_without_probe_keeps_scale():
+    assert sc.plan_video_filter(settings(), 0) == ["scale=1920:1080", "setdar=16/9"]
+
+
+def test_probe_without_rotation_keeps_scale():
+    info = video()
+    del info["video"]["rotation"]
+    assert sc.plan_video_filter(settings(), 0, info) == ["scale=1920:1080", "setdar=16/9"]
+
+
+def test_crop_and_downscale():
+    graph = sc.plan_video_filter(settings(resolution="1280x720", crop_top=60, crop_bottom=60), 0, video())
+    assert graph == ["crop=iw-0-0:ih-60-60:0:60", "scale=1280:720", "setdar=16/9"]
+
+
+def test_crop_to_target_size_elides_scale():
+    graph = sc.plan_video_filter(settings(resolution="1280x720", crop_top=60, crop_bottom=60), 0, video(1280, 840))
+    assert graph == ["crop=iw-0-0:ih-60-60:0:60", "setdar=16/9"]
+
+
+def test_lower_frame_rate_runs_first():
+    graph = sc.plan_video_filter(settings(resolution="1280x720", fps="30"), 0, video(3840, 2160, fps=60.0))
+    assert graph == ["fps=30", "scale=1280:720", "setdar=16/9"]
+
+
+def test_higher_frame_rate_runs_last():
+    graph = sc.plan_video_filter(settings(fps="30"), 0, video(fps=24.0))
+    assert graph == ["setdar=16/9", "fps=30"]
+
+
+def test_matching_frame_rate_is_elided():
+    assert sc.plan_video_filter(settings(fps="30"), 0, video(fps=30.0)) == ["setdar=16/9"]
+
+
+def test_ten_bit_source_converts_after_scaling():
+    graph = sc.plan_video_filter(settings(resolution="1280x720"), 0, video(3840, 2160, pix_fmt="yuv420p10le"))
+    assert graph == ["scale=1280:720", "format=yuv420p", "setdar=16/9"]
+
+
+def test_full_range_source_needs_no_conversion():
+    assert "format=yuv420p" not in sc.plan_video_filter(settings(), 0, video(pix_fmt="yuvj420p"))
+
+
+def test_vaapi_uploads_and_scales_on_gpu():
+    graph = sc.plan_video_filter(settings(encoder="h264_vaapi", resolution="1280x720", fps="30"), 0, video(fps=60.0))
+    assert graph == ["fps=30", "format=nv12", "hwupload", "scale_vaapi=w=1280:h=720", "setdar=16/9"]
+
+
+def test_vaapi_nv12_source_at_target_size_only_uploads():
+    graph = sc.plan_video_filter(settings(encoder="h264_vaapi"), 0, video(pix_fmt="nv12"))
+    assert graph == ["hwupload", "setdar=16/9"]
+
+
+def test_videotoolbox_converts_unknown_pixel_format():
+    graph = sc.plan_video_filter(settings(encoder="h264_videotoolbox"), 0)
+    assert graph == ["scale=1920:1080", "format=yuv420p", "setdar=16/9"]
+
+
+def test_rotated_source_compares_display_size():
+    assert sc.plan_video_filter(settings(), 0, video(1080, 1920, rotation=-90)) == ["setdar=16/9"]
+    graph = sc.plan_video_filter(settings(resolution="1280x720"), 0, video(1080, 1920, rotation=90))
+    assert graph == ["scale=1280:720", "setdar=16/9"]
+
+
+def test_subtitles_without_seek_skip_timestamp_shift():
+    graph = sc.plan_video_filter(settings(subtitle_file="internal:1"), 0, video())
+    assert len(graph) == 2
+    assert graph[0].startswith("subtitles='/media/show.mkv':si=1:force_style=")
+    assert graph[1] == "setdar=16/9"
+
+
+def test_subtitles_after_seek_shift_timestamps_around_burn():
+    graph = sc.plan_video_filter(settings(subtitle_file="internal:1", resolution="1280x720"), 95, video())
+    assert graph[:2] == ["scale=1280:720", "setpts=PTS+95/TB"]
+    assert graph[2].startswith("subtitles='/media/show.mkv':si=1")
+    assert graph[3:] == ["setpts=PTS-95/TB", "setdar=16/9"]
+
+
+def test_vaapi_burns_subtitles_before_upload():
+    graph = sc.plan_video_filter(settings(encoder="h264_vaapi", subtitle_file="internal:0"), 0, video())
+    assert graph[0].startswith("subtitles=")
+    assert graph[1:] == ["format=nv12", "hwupload", "setdar=16/9"]
+
+
+def test_build_video_filter_uses_source_info():
+    assert sc.build_video_filter(settings(source_info=video()), 0) == "setdar=16/9"